@@ -53,6 +53,105 @@ for root, dirs, files in os.walk(os.getcwd()) :
         print(os.path.join(root,file))
 
 
+# ## Scanning large directory trees with `os.scandir`
+# 
+# `os.walk` is convenient, but when a directory tree contains millions of files, listing it can take minutes. We can make this faster in two ways:
+# 
+# * The [`os.scandir`](https://docs.python.org/3/library/os.html#os.scandir) function returns `DirEntry` objects instead of names. A `DirEntry` already knows whether it's a directory, and its `stat()` results are cached (on Windows they're even included in the directory listing), so we avoid calling `os.stat` on every file.
+# * Different subdirectories can be scanned at the same time using a pool of threads. This helps most on network drives and slow disks, where most of the time is spent waiting for the file system.
+# 
+# Instead of printing the paths, the scanner returns a generator of lightweight `FileEntry` tuples containing the path, name, size, modification time and inode number of each file, which can be filtered or processed further.
+
+# In[ ]:
+
+
+import re
+import fnmatch
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+FileEntry = namedtuple('FileEntry', ['path', 'name', 'is_dir', 'size', 'mtime_ns', 'inode'])
+
+
+# The function `scan_directory` lists a single directory and returns the matching entries, along with the subdirectories that still need to be scanned. The filters are glob patterns like `loans*.txt` or `*.csv`, which are combined into a single regular expression using `fnmatch.translate`. Directories that can't be read (e.g. due to missing permissions) are skipped, just like `os.walk` does. Files that are deleted while the directory is being scanned are skipped too, without losing the rest of the directory.
+
+# In[ ]:
+
+
+def compile_patterns(pattern):
+    if pattern is None:
+        return None
+    patterns = [pattern] if isinstance(pattern, str) else pattern
+    return re.compile('|'.join(fnmatch.translate(os.path.normcase(p)) for p in patterns)).match
+
+def scan_directory(path, match=None, include_dirs=False, with_stat=True):
+    entries, subdirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if is_dir:
+                        subdirs.append(entry.path)
+                        if not include_dirs:
+                            continue
+                    if match is not None and not match(os.path.normcase(entry.name)):
+                        continue
+                    if with_stat:
+                        stat = entry.stat(follow_symlinks=False)
+                        entries.append(FileEntry(entry.path, entry.name, is_dir, stat.st_size, stat.st_mtime_ns, entry.inode()))
+                    else:
+                        entries.append(FileEntry(entry.path, entry.name, is_dir, None, None, entry.inode()))
+                except OSError:
+                    # Skip entries that were deleted (or can't be read) while scanning
+                    continue
+    except OSError:
+        # The directory can't be listed
+        pass
+    return entries, subdirs
+
+
+# Finally, `scan_tree` scans a directory and all its subdirectories using a pool of threads. As soon as a directory has been scanned, its subdirectories are submitted to the pool and its entries are returned. The order of the entries is therefore not fixed. Pass `stat=False` to skip reading the size and modification time, if only the paths are needed.
+
+# In[ ]:
+
+
+def scan_tree(top='.', pattern=None, include_dirs=False, stat=True, workers=8):
+    match = compile_patterns(pattern)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = {executor.submit(scan_directory, top, match, include_dirs, stat)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries, subdirs = future.result()
+                for subdir in subdirs:
+                    pending.add(executor.submit(scan_directory, subdir, match, include_dirs, stat))
+                yield from entries
+    finally:
+        # Stop scanning if the generator is closed early
+        executor.shutdown(cancel_futures=True)
+
+
+# Here's the equivalent of the `os.walk` example above:
+
+# In[ ]:
+
+
+for entry in scan_tree(os.getcwd(), include_dirs=True):
+    print(entry.path)
+
+
+# We can also look for specific files, e.g. all the Jupyter notebooks, along with their sizes:
+
+# In[ ]:
+
+
+[(entry.name, entry.size) for entry in scan_tree(os.getcwd(), pattern='*.ipynb')]
+
+
+# Multiple patterns can be passed as a list, e.g. `pattern=['loans*.txt', '*.csv']`.
+
 # # 4) Creating a Folder with `os.mkdir` Function
 
 # In[6]:
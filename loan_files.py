@@ -0,0 +1,650 @@
+"""Read loan files, compute their EMIs and write the results.
+
+The core functions from the `python-os-and-filesystem` notebook, packaged
+as a module that can be imported by scripts and worker processes. Only
+modules from the standard library are imported at startup; `pandas` is
+imported the first time `to_dataframe` or `read_dataframe` is called, and
+the compression modules (`gzip`, `bz2`, `lzma` and `zstandard`) the first
+time a compressed file is opened.
+
+Run `python loan_files.py INPUT OUTPUT` to process a file,
+`python loan_files.py --startup-benchmark` to measure the import time, or
+`python loan_files.py --check-notebook` to check that the functions haven't
+drifted apart from their versions in the notebook.
+"""
+import csv
+import io
+import itertools
+import math
+import os
+import struct
+import sys
+import threading
+import zlib
+from collections import deque
+from functools import lru_cache, partial
+from itertools import islice, chain, repeat
+from operator import itemgetter
+
+SPECIAL_FLOATS = {'inf', 'infinity', 'nan'}
+
+
+# Compressed files (the compression modules are imported when they're first used)
+
+COMPRESSION_MAGIC = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.zst': 'zstd'}
+
+def detect_compression(path):
+    with open(path, 'rb') as f:
+        start = f.read(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if start.startswith(magic):
+            return compression
+    return None
+
+def compression_from_extension(path):
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+def import_zstd():
+    try:
+        from compression import zstd
+    except ImportError:
+        try:
+            import zstandard as zstd
+        except ImportError:
+            return None
+    return zstd
+
+BGZF_HEADER = b'\x1f\x8b\x08\x04'
+BGZF_BLOCK_SIZE = 65280
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def bgzf_block_size(data, start):
+    if data[start:start+4] != BGZF_HEADER:
+        return None
+    extra_length, = struct.unpack_from('<H', data, start + 10)
+    offset, end = start + 12, start + 12 + extra_length
+    while offset + 4 <= end:
+        subfield, length = data[offset:offset+2], struct.unpack_from('<H', data, offset + 2)[0]
+        if subfield == b'BC' and length == 2:
+            return struct.unpack_from('<H', data, offset + 4)[0] + 1
+        offset += 4 + length
+    return None
+
+def read_bgzf_block(f):
+    # Read the fixed part of the header, then the extra field, then the rest of the block
+    header = f.read(12)
+    if header == b'':
+        return b''
+    if len(header) < 12 or header[:4] != BGZF_HEADER:
+        return None
+    extra_length, = struct.unpack_from('<H', header, 10)
+    header += f.read(extra_length)
+    size = bgzf_block_size(header, 0) if len(header) == 12 + extra_length else None
+    if size is None or size < len(header):
+        return None
+    rest = f.read(size - len(header))
+    if len(rest) < size - len(header):
+        return None
+    return header + rest
+
+def iter_bgzf_chunks(path, workers):
+    import gzip
+    from concurrent.futures import ThreadPoolExecutor
+    with open(path, 'rb') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        while True:
+            start = f.tell()
+            block = read_bgzf_block(f)
+            if not block:
+                break
+            # Decompress the block as a gzip member (wbits=31), which checks its CRC
+            pending.append(executor.submit(zlib.decompress, block, 31))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+        
+        if block is None:
+            # The rest of the file isn't BGZF (e.g. a gzip file was appended to it),
+            # so decompress it from the start of that member, one member after another
+            f.seek(start)
+            with gzip.GzipFile(fileobj=f) as rest:
+                while True:
+                    chunk = rest.read(1024*1024)
+                    if not chunk:
+                        break
+                    yield chunk
+
+class ChunkReader(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = b''
+        self.offset = 0
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while self.offset == len(self.chunk):
+            self.chunk = next(self.chunks, None)
+            self.offset = 0
+            if self.chunk is None:
+                self.chunk = b''
+                return 0
+        n = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:n] = self.chunk[self.offset:self.offset+n]
+        self.offset += n
+        return n
+    
+    def close(self):
+        self.chunks.close()
+        super().close()
+
+def compress_bgzf_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4sIBBH2sHH', BGZF_HEADER, 0, 0, 255, 6, b'BC', 2, len(compressed) + 25)
+    return header + compressed + struct.pack('<II', zlib.crc32(data), len(data))
+
+class BlockGzipWriter(io.RawIOBase):
+    def __init__(self, path, workers=4, level=6):
+        from concurrent.futures import ThreadPoolExecutor
+        self.file = open(path, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.level = level
+        self.buffer = bytearray()
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= BGZF_BLOCK_SIZE * self.workers:
+            self.write_blocks(len(self.buffer) // BGZF_BLOCK_SIZE * BGZF_BLOCK_SIZE)
+        return len(data)
+    
+    def write_blocks(self, size):
+        blocks = [bytes(self.buffer[i:i+BGZF_BLOCK_SIZE]) for i in range(0, size, BGZF_BLOCK_SIZE)]
+        del self.buffer[:size]
+        for block in self.executor.map(compress_bgzf_block, blocks, repeat(self.level)):
+            self.file.write(block)
+    
+    def close(self):
+        if not self.closed:
+            try:
+                self.write_blocks(len(self.buffer))
+                self.file.write(BGZF_EOF)
+            finally:
+                self.executor.shutdown()
+                self.file.close()
+        super().close()
+
+def open_compressed(path, mode='r', compression='infer', workers=1):
+    if compression == 'infer':
+        compression = detect_compression(path) if mode == 'r' else compression_from_extension(path)
+    if compression is None:
+        return open(path, mode, buffering=1024*1024)
+    if mode not in ('r', 'w'):
+        raise ValueError('compressed files can only be opened for reading or writing, not {!r}'.format(mode))
+    
+    if compression == 'gzip' and workers > 1:
+        if mode == 'w':
+            return io.TextIOWrapper(io.BufferedWriter(BlockGzipWriter(path, workers), 1024*1024))
+        with open(path, 'rb') as f:
+            is_bgzf = bgzf_block_size(f.read(1024), 0) is not None
+        if is_bgzf:
+            return io.TextIOWrapper(io.BufferedReader(ChunkReader(iter_bgzf_chunks(path, workers)), 1024*1024))
+    if compression == 'gzip':
+        import gzip
+        return gzip.open(path, mode + 't', compresslevel=6)
+    if compression == 'bz2':
+        import bz2
+        return bz2.open(path, mode + 't')
+    if compression == 'xz':
+        import lzma
+        return lzma.open(path, mode + 't')
+    if compression == 'zstd':
+        zstd = import_zstd()
+        if zstd is None:
+            raise ValueError('reading or writing .zst files requires the zstandard package')
+        return zstd.open(path, mode + 't')
+    raise ValueError('unknown compression: {!r}'.format(compression))
+
+
+# Reading
+
+def split_quoted_line(data_line):
+    return next(csv.reader([data_line]))
+
+def parse_headers(header_line):
+    if '"' in header_line:
+        return split_quoted_line(header_line.strip())
+    return header_line.strip().split(',')
+
+def parse_number(item):
+    if item == '':
+        return 0.0
+    return float(item)
+
+def parse_value(item):
+    if item == '':
+        return 0.0
+    first = item[0]
+    if first.isdigit() or first in '+-.' or first.isspace() or item.strip().lower() in SPECIAL_FLOATS:
+        try:
+            return float(item)
+        except ValueError:
+            pass
+    return item
+
+def parse_values(data_line):
+    if '"' in data_line:
+        return [parse_value(item) for item in split_quoted_line(data_line.strip())]
+    values = []
+    for item in data_line.strip().split(','):
+        if item == '':
+            values.append(0.0)
+        else:
+            try:
+                values.append(float(item))
+            except ValueError:
+                values.append(item)
+    return values
+
+def parse_numeric_line(data_line):
+    return [float(item) if item else 0.0 for item in data_line.strip().split(',')]
+
+def infer_converters(sample_lines, num_columns):
+    numeric = [True] * num_columns
+    for data_line in sample_lines:
+        if '"' in data_line:
+            items = split_quoted_line(data_line.strip())
+        else:
+            items = data_line.strip().split(',')
+        for i, item in enumerate(items[:num_columns]):
+            if type(parse_value(item)) is not float:
+                numeric[i] = False
+    return [parse_number if is_numeric else parse_value for is_numeric in numeric]
+
+def make_line_parser(converters):
+    num_columns = len(converters)
+    numeric_columns = [i for i, convert in enumerate(converters) if convert is parse_number]
+    other_columns = [i for i, convert in enumerate(converters) if convert is not parse_number]
+
+    def parse_line(data_line):
+        if '"' in data_line:
+            items = split_quoted_line(data_line.strip())
+        else:
+            items = data_line.strip().split(',')
+        if len(items) == num_columns:
+            try:
+                for i in numeric_columns:
+                    item = items[i]
+                    items[i] = float(item) if item else 0.0
+                for i in other_columns:
+                    items[i] = converters[i](items[i])
+                return items
+            except ValueError:
+                pass
+        # Fall back to parsing lines that don't match the sample
+        return parse_values(data_line)
+
+    return parse_line
+
+def read_record(data_line, lines):
+    while data_line.count('"') % 2 == 1:
+        next_line = next(lines, None)
+        if next_line is None:
+            break
+        data_line += next_line
+    return data_line
+
+def create_item_dict(values, headers):
+    result = {}
+    for value, header in zip(values, headers):
+        result[header] = value
+    return result
+
+def iter_csv_lines(lines, sample_size=100, strict=False):
+    lines = iter(lines)
+    # Parse the header (an empty file has no rows)
+    header_line = next(lines, '')
+    if header_line == '':
+        return
+    headers = parse_headers(header_line)
+    # Choose how to parse the lines
+    if not strict:
+        sample = list(islice(lines, sample_size))
+        parse_line = make_line_parser(infer_converters(sample, len(headers)))
+        lines = chain(sample, lines)
+    else:
+        parse_line = parse_numeric_line
+    create_item = partial(create_item_dict, headers=headers)
+    # Parse the lines one by one
+    for data_line in lines:
+        # Rows with quoted values can span multiple lines
+        if '"' in data_line and data_line.count('"') % 2 == 1:
+            data_line = read_record(data_line, lines)
+        yield create_item(parse_line(data_line))
+
+def iter_csv(path, sample_size=100, strict=False, compression='infer', workers=1):
+    # Open the (possibly compressed) file in read mode
+    with open_compressed(path, 'r', compression, workers) as f:
+        yield from iter_csv_lines(f, sample_size, strict)
+
+def read_csv(path, sample_size=100, strict=False, compression='infer', workers=1):
+    return list(iter_csv(path, sample_size, strict, compression, workers))
+
+
+# Computing EMIs
+
+def loan_emi(amount, duration, rate, down_payment=0):
+    """Calculates the equal montly installment (EMI) for a loan.
+
+    Arguments:
+        amount - Total amount to be spent (loan + down payment)
+        duration - Duration of the loan (in months)
+        rate - Rate of interest (monthly)
+        down_payment (optional) - Optional intial payment (deducted from amount)
+    """
+    loan_amount = amount - down_payment
+    try:
+        emi = loan_amount * rate * ((1+rate)**duration) / (((1+rate)**duration)-1)
+    except ZeroDivisionError:
+        emi = loan_amount / duration
+    emi = math.ceil(emi)
+    return emi
+
+def make_cached_loan_emi(maxsize=100000, factor_maxsize=10000):
+    @lru_cache(maxsize=factor_maxsize)
+    def growth_factor(rate, duration):
+        return (1+rate)**duration
+
+    @lru_cache(maxsize=maxsize)
+    def cached_loan_emi(amount, duration, rate, down_payment=0):
+        loan_amount = amount - down_payment
+        factor = growth_factor(rate, duration)
+        try:
+            emi = loan_amount * rate * factor / (factor-1)
+        except ZeroDivisionError:
+            emi = loan_amount / duration
+        emi = math.ceil(emi)
+        return emi
+
+    cached_loan_emi.growth_factor = growth_factor
+    return cached_loan_emi
+
+cached_loan_emi = make_cached_loan_emi()
+
+def iter_emis(loans):
+    for loan in loans:
+        loan['emi'] = cached_loan_emi(
+            loan['amount'],
+            loan['duration'],
+            loan['rate']/12, # the CSV contains yearly rates
+            loan['down_payment'])
+        yield loan
+
+def compute_emis(loans):
+    loans[:] = iter_emis(loans)
+
+
+# Writing
+
+def quote_value(text):
+    if ',' in text or '"' in text or '\n' in text or '\r' in text:
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+def make_row_formatter(headers, formats=None):
+    if formats is None:
+        formats = {}
+    column_formats = [formats.get(header, '%s') for header in headers]
+    template = ','.join(column_formats)
+    num_separators = len(headers) - 1
+    getter = itemgetter(*headers)
+
+    def format_values(item):
+        # Missing values are written as empty strings
+        return [column_format % (item[header],) if header in item else ''
+                for column_format, header in zip(column_formats, headers)]
+
+    def format_row(item):
+        try:
+            values = getter(item)
+        except KeyError:
+            return ','.join(map(quote_value, format_values(item)))
+        if len(headers) == 1:
+            values = (values,)
+        row = template % values
+        # Quote the values if required
+        if '"' in row or '\n' in row or '\r' in row or row.count(',') != num_separators:
+            return ','.join(map(quote_value, format_values(item)))
+        return row
+
+    return format_row
+
+def write_rows(f, items, formats=None, batch_size=1000, write_headers=None):
+    count = 0
+    # Return if there's nothing to write
+    items = iter(items)
+    first_item = next(items, None)
+    if first_item is None:
+        return count
+
+    # Write the headers in the first line (unless we're appending to a file)
+    headers = list(first_item.keys())
+    if write_headers is None:
+        write_headers = f.tell() == 0
+    if write_headers:
+        f.write(','.join(map(quote_value, headers)) + '\n')
+
+    # Write the items in batches
+    format_row = make_row_formatter(headers, formats)
+    batch = [format_row(first_item)]
+    for item in items:
+        batch.append(format_row(item))
+        if len(batch) >= batch_size:
+            f.write('\n'.join(batch) + '\n')
+            count += len(batch)
+            batch = []
+    if batch:
+        f.write('\n'.join(batch) + '\n')
+        count += len(batch)
+    return count
+
+temp_path_counter = itertools.count()
+
+def temp_output_path(path):
+    # A unique name, so that several threads or processes (or several writes
+    # from the same thread) can write the same file
+    return '{}.{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident(), next(temp_path_counter))
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_directory(directory):
+    if os.name != 'posix':
+        return
+    fd = os.open(directory or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_csv(items, path, mode='w', formats=None, batch_size=1000, buffer_size=1024*1024, atomic=True, sync=False, 
+              compression='infer', workers=1):
+    if compression == 'infer':
+        compression = compression_from_extension(path)
+    atomic = atomic and mode == 'w'
+    target = temp_output_path(path) if atomic else path
+    try:
+        # Open the file in write (or append) mode
+        if compression is None:
+            f = open(target, mode, buffering=buffer_size)
+        else:
+            f = open_compressed(target, mode, compression, workers)
+        with f:
+            count = write_rows(f, items, formats, batch_size, write_headers=True if compression else None)
+        # Compressed data is only complete once the file is closed
+        if sync:
+            fsync_path(target)
+    except BaseException:
+        if atomic and os.path.exists(target):
+            os.remove(target)
+        raise
+
+    # Replace the destination with the complete file
+    if atomic:
+        os.replace(target, path)
+        if sync:
+            fsync_directory(os.path.dirname(path))
+    return count
+
+def process_file(input_path, output_path):
+    loans = read_csv(input_path)
+    compute_emis(loans)
+    write_csv(loans, output_path)
+    return len(loans)
+
+
+# Pandas interoperability (pandas is only imported when these are used)
+
+def to_dataframe(rows):
+    import pandas as pd
+    return pd.DataFrame.from_records(rows)
+
+def read_dataframe(path):
+    return to_dataframe(iter_csv(path))
+
+
+# Startup benchmark
+
+def measure_startup(repeat=10):
+    """Returns the shortest time (in seconds) taken by a new Python process to import
+    this module, along with the time taken by a new Python process that imports nothing.
+    """
+    import subprocess
+    import time
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def best_time(code):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=directory, check=True)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    return best_time('import loan_files'), best_time('pass')
+
+# Checking for differences with the notebook
+
+NOTEBOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python-os-and-filesystem.ipynb')
+
+# Definitions which only exist in this module
+MODULE_ONLY = {'import_zstd', 'to_dataframe', 'read_dataframe', 'measure_startup', 'NOTEBOOK_PATH', 'MODULE_ONLY',
+               'NOTEBOOK_DIFFERENCES', 'definition_fingerprints', 'notebook_fingerprints', 'check_notebook', 'main'}
+
+# Definitions which intentionally differ from their latest version in the notebook, with the
+# fingerprints of the notebook's version and this module's version when they were last compared.
+# If either version changes, `check_notebook` reports it, so that the other one can be updated
+# (followed by the fingerprints, using `definition_fingerprints` and `notebook_fingerprints`).
+NOTEBOOK_DIFFERENCES = {
+    'iter_bgzf_chunks': ('imports gzip and concurrent.futures when called', '1b60a562211c', 'c57bb076f403'),
+    'BlockGzipWriter': ('imports concurrent.futures when created', 'e07947082aa4', '25bb55133d74'),
+    'open_compressed': ('imports the compression modules when called', 'ceafcd068164', '87f81229899c'),
+    'parse_value': ('no instrumentation', '46032423ea42', 'aa582364c3f2'),
+    'parse_values': ('no instrumentation', '06d6cb7aff75', '232d24b0f493'),
+    'make_line_parser': ('no instrumentation', '6e06aa807fe2', '6321cc1ea021'),
+    'iter_csv_lines': ('no records or instrumentation', '8c9e181a87b2', 'f94b434fd32d'),
+    'iter_csv': ('no records', '8cc3e6370465', 'e1a9dea81df9'),
+    'read_csv': ('no parallel parsing, records or sidecar files', 'eada9416292d', 'b73a35853766'),
+    'loan_emi': ('no instrumentation', '09d21793c4b0', 'ffa66617e5a4'),
+    'make_cached_loan_emi': ('no LFU policy or instrumentation', '8066f0eddaaa', 'cac00ac5cd2a'),
+    'iter_emis': ('no records or annuity table', '06129dd76227', 'fc716e23c940'),
+    'make_row_formatter': ('no records', '0a4caa71faa7', 'e4596d714704'),
+    'write_rows': ('no records', '4d642a3e34bd', '35749f390c9d'),
+    'write_csv': ('no group commit', '8a83746e31bf', '9188c284f4f4'),
+    'process_file': ('no instrumentation', '3a6031d3aca4', '8923272733e1'),
+}
+
+def definition_fingerprints(source):
+    """Returns a short hash of the source code of each top-level function, class and
+    variable defined in `source`, ignoring trailing whitespace.
+    """
+    import ast
+    import hashlib
+    fingerprints = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            name = node.name
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+        else:
+            continue
+        text = '\n'.join(line.rstrip() for line in ast.get_source_segment(source, node).splitlines())
+        fingerprints[name] = hashlib.sha1(text.encode()).hexdigest()[:12]
+    return fingerprints
+
+def notebook_fingerprints(notebook_path=NOTEBOOK_PATH):
+    """Returns the fingerprints of the latest definition of each name in the notebook."""
+    import json
+    with open(notebook_path, 'r') as f:
+        notebook = json.load(f)
+    fingerprints = {}
+    for cell in notebook['cells']:
+        if cell['cell_type'] != 'code':
+            continue
+        try:
+            fingerprints.update(definition_fingerprints(''.join(cell['source'])))
+        except SyntaxError:
+            # Cells containing IPython commands (e.g. `!pip install`) don't define anything
+            continue
+    return fingerprints
+
+def check_notebook(notebook_path=NOTEBOOK_PATH):
+    """Returns a list of the definitions which differ from their latest version in the notebook
+    (apart from the expected differences listed in `NOTEBOOK_DIFFERENCES`).
+    """
+    with open(os.path.abspath(__file__), 'r') as f:
+        module = definition_fingerprints(f.read())
+    notebook = notebook_fingerprints(notebook_path)
+    problems = []
+    for name, fingerprint in module.items():
+        if name in MODULE_ONLY:
+            continue
+        if name not in notebook:
+            problems.append('{}: not defined in the notebook'.format(name))
+        elif name in NOTEBOOK_DIFFERENCES:
+            reason, notebook_fingerprint, module_fingerprint = NOTEBOOK_DIFFERENCES[name]
+            if (notebook[name], fingerprint) != (notebook_fingerprint, module_fingerprint):
+                problems.append('{}: changed since it was last compared with the notebook ({})'.format(name, reason))
+        elif notebook[name] != fingerprint:
+            problems.append('{}: differs from the notebook'.format(name))
+    return problems
+
+def main(args):
+    if args == ['--check-notebook']:
+        problems = check_notebook()
+        for problem in problems:
+            print(problem)
+        return 1 if problems else 0
+    if args == ['--startup-benchmark']:
+        startup, baseline = measure_startup()
+        print('import loan_files: {:.1f} ms (empty interpreter: {:.1f} ms)'.format(startup * 1000, baseline * 1000))
+        return 0 if startup < 0.05 else 1
+    if len(args) != 2:
+        print('usage: python loan_files.py INPUT OUTPUT | --startup-benchmark | --check-notebook', file=sys.stderr)
+        return 2
+    print(process_file(args[0], args[1]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -861,6 +861,4249 @@ pd.read_csv('movies3.csv')
 # 
 # In general, it's always a better idea to use libraries like Pandas for reading and writing CSV files. 
 
+# ## Processing large files efficiently
+# 
+# The functions we've defined so far work well for small files like `loans1.txt`. In practice, you may need to process files that are several gigabytes in size, or thousands of files at once. In this section, we'll look at a few techniques for making `read_csv`, `compute_emis` and `write_csv` faster and more memory-efficient.
+# 
+# ### Reading a file lazily using a generator
+# 
+# The `read_csv` function reads the entire file into a list of lines using `readlines`, creates a second copy of the list with `lines[1:]` and then builds a list containing one dictionary for each line. For a large file, this can require several times the size of the file in memory.
+# 
+# A file object can also be used as an *iterator*: looping over it with `for` returns one line at a time, without reading the whole file into memory. We can combine this with a [*generator function*](https://docs.python.org/3/howto/functional.html#generators), which uses the `yield` keyword to return values one by one, to process a file row by row.
+
+# In[ ]:
+
+
+def iter_csv(path):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header (an empty file has no rows)
+        header_line = f.readline()
+        if header_line == '':
+            return
+        headers = parse_headers(header_line)
+        # Read the remaining lines one by one
+        for data_line in f:
+            # Parse the values & create a dictionary
+            values = parse_values(data_line)
+            yield create_item_dict(values, headers)
+
+
+# Calling `iter_csv` doesn't read anything from the file yet. It returns a *generator* object, and each row is read, parsed and returned only when we ask for it (e.g. using a `for` loop).
+
+# In[ ]:
+
+
+loans_iter = iter_csv('./data/loans2.txt')
+loans_iter
+
+
+# In[ ]:
+
+
+for loan in loans_iter:
+    print(loan)
+
+
+# Since only one line of the file is held in memory at a time, we can use `iter_csv` to process files of any size with a constant amount of memory. For example, here's how we can compute the total amount of all the loans in a file:
+
+# In[ ]:
+
+
+sum(loan['amount'] for loan in iter_csv('./data/loans1.txt'))
+
+
+# The `read_csv` function can now be defined as a thin wrapper around `iter_csv`, which collects all the rows into a list.
+
+# In[ ]:
+
+
+def read_csv(path):
+    return list(iter_csv(path))
+
+
+# In[ ]:
+
+
+read_csv('./data/loans2.txt')
+
+
+# ### Storing columns in typed arrays
+# 
+# A list of dictionaries is a convenient way to represent the rows of a CSV file, but it isn't very memory efficient: every row needs its own dictionary, and every number is stored as a separate Python `float` object. For a loan with four numbers, this can take around 10 times more memory than the numbers themselves.
+# 
+# As suggested in the exercise at the end of this tutorial, we can store the data as a *dictionary of lists* instead, with one list for each column. We can go a step further and store each numeric column in an [`array`](https://docs.python.org/3/library/array.html) from the built-in `array` module, which stores numbers compactly as raw 8-byte values: `array('d')` for floating point numbers and `array('q')` for integers. If the [`numpy`](https://numpy.org) library is installed, we'll convert the columns to NumPy arrays, which we'll use in the next section to perform computations on entire columns at once.
+
+# In[ ]:
+
+
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# The type of each column is inferred from the values returned by `parse_values`. A column starts out as an `array('d')`, and is converted to a list only if it contains a value that couldn't be parsed as a number. Once the whole file has been read, columns containing only whole numbers are converted to `array('q')`.
+
+# In[ ]:
+
+
+def compact_column(column):
+    # Non-numeric columns are stored as lists
+    if type(column) is list:
+        return column
+    # Store whole numbers as 64-bit integers
+    if all(value.is_integer() and -2**63 <= value < 2**63 for value in column):
+        column = array('q', map(int, column))
+    # Convert to a NumPy array (without copying the data) if available
+    if np is not None:
+        return np.frombuffer(column, dtype=column.typecode)
+    return column
+
+def read_csv_columnar(path):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header (an empty file has no columns)
+        header_line = f.readline()
+        if header_line == '':
+            return {}
+        headers = parse_headers(header_line)
+        # Create an empty numeric column for each header
+        columns = [array('d') for _ in headers]
+        # Read the remaining lines one by one
+        for data_line in f:
+            values = parse_values(data_line)
+            for i, column in enumerate(columns):
+                # Missing values at the end of a line are treated like empty values
+                value = values[i] if i < len(values) else 0.0
+                # Switch to a list if the value isn't a number
+                if type(value) is not float and type(column) is array:
+                    column = columns[i] = list(column)
+                column.append(value)
+    return {header: compact_column(column) for header, column in zip(headers, columns)}
+
+
+# Let's try it out!
+
+# In[ ]:
+
+
+loans2_columns = read_csv_columnar('./data/loans2.txt')
+loans2_columns
+
+
+# We can compare the memory used by both representations of the same file. The function `sys.getsizeof` returns the size of an object in bytes, while the size of the data stored in an array is its `itemsize` (the number of bytes per value) multiplied by its length.
+
+# In[ ]:
+
+
+import sys
+
+loans1_rows = read_csv('./data/loans1.txt')
+sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values()) for row in loans1_rows)
+
+
+# In[ ]:
+
+
+loans1_columns = read_csv_columnar('./data/loans1.txt')
+sum(column.itemsize * len(column) for column in loans1_columns.values())
+
+
+# The difference becomes much larger as the number of rows grows, since each column only needs 8 bytes per row.
+
+# ### Computing EMIs for entire columns at once
+# 
+# The `compute_emis` function calls `loan_emi` once for each loan in a Python loop, and `loan_emi` relies on catching a `ZeroDivisionError` to handle loans with a zero rate of interest. For millions of loans, this loop ends up being the slowest part of the program.
+# 
+# With the data stored in columns, we can compute the EMIs for all the loans using a single expression, which NumPy evaluates for entire arrays at once (this is called *vectorization*). Instead of catching an exception, we create a *mask*: an array of `True`/`False` values indicating the loans for which the usual formula would divide by zero, and use `np.where` to pick the simpler formula `loan_amount / duration` for those loans.
+# 
+# If NumPy isn't installed, we fall back to a regular loop over the arrays, which still avoids the `try`/`except`.
+
+# In[ ]:
+
+
+def loan_emis(amount, duration, rate, down_payment=0):
+    """Calculates the equal montly installments (EMIs) for columns of loans.
+    
+    Arguments:
+        amount - Total amounts to be spent (loan + down payment)
+        duration - Durations of the loans (in months)
+        rate - Rates of interest (monthly)
+        down_payment (optional) - Optional intial payments (deducted from amount)
+    
+    Each argument can be a NumPy array or an `array` (down_payment can also be a single number).
+    """
+    if np is None:
+        if not isinstance(down_payment, (array, list)):
+            down_payment = [down_payment] * len(amount)
+        emis = array('q')
+        for loan_amount, loan_duration, loan_rate, loan_down_payment in zip(amount, duration, rate, down_payment):
+            loan_amount = loan_amount - loan_down_payment
+            factor = (1+loan_rate)**loan_duration
+            if factor == 1:
+                emi = loan_amount / loan_duration
+            else:
+                emi = loan_amount * loan_rate * factor / (factor-1)
+            emis.append(math.ceil(emi))
+        return emis
+    
+    amount, duration, rate = np.asarray(amount), np.asarray(duration), np.asarray(rate)
+    loan_amount = amount - np.asarray(down_payment)
+    factor = (1+rate)**duration
+    # Loans for which the formula would divide by zero (e.g. a zero rate)
+    mask = factor == 1
+    if np.any(mask & (duration == 0)):
+        raise ZeroDivisionError('loan duration is zero')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        emis = np.where(mask, loan_amount / duration, loan_amount * rate * factor / (factor-1))
+    return np.ceil(emis).astype(np.int64)
+
+
+# We can now define `compute_emis_columnar`, which adds a new column `emi` to a dictionary of columns.
+
+# In[ ]:
+
+
+def compute_emis_columnar(columns):
+    rate = columns['rate']
+    # The CSV contains yearly rates
+    if np is not None:
+        monthly_rate = np.asarray(rate) / 12
+    else:
+        monthly_rate = array('d', (loan_rate / 12 for loan_rate in rate))
+    columns['emi'] = loan_emis(columns['amount'], 
+                               columns['duration'], 
+                               monthly_rate, 
+                               columns['down_payment'])
+
+
+# In[ ]:
+
+
+loans2_columns = read_csv_columnar('./data/loans2.txt')
+compute_emis_columnar(loans2_columns)
+loans2_columns
+
+
+# Let's verify that the results match the ones computed by `compute_emis`.
+
+# In[ ]:
+
+
+loans2 = read_csv('./data/loans2.txt')
+compute_emis(loans2)
+[loan['emi'] for loan in loans2]
+
+
+# ### Processing many files in parallel
+# 
+# Earlier, we processed the files `loans1.txt` to `loans3.txt` one after another using a `for` loop. The files are completely independent of each other, so there's no reason to wait for one file to be processed before starting the next one. Most computers have several CPU cores, but a Python program only uses one of them at a time.
+# 
+# The [`concurrent.futures`](https://docs.python.org/3/library/concurrent.futures.html) module provides a `ProcessPoolExecutor`, which starts several *worker processes* and runs function calls in them. Each call to `submit` returns a *future* object, which can later be used to get the result of the call (or the exception it raised).
+# 
+# Let's start by putting the steps for processing a single file into a function.
+
+# In[ ]:
+
+
+def process_file(input_path, output_path):
+    loans = read_csv(input_path)
+    compute_emis(loans)
+    write_csv(loans, output_path)
+    return len(loans)
+
+
+# Next, let's define a function `process_files`, which processes a list of files using a pool of worker processes. Here's how it works:
+# 
+# * The path of each output file is created using `output_pattern.format(...)`, with the position of the input file (starting from 1) and its name without the extension (as `name`). For example, `'./data/emis{}.txt'` creates `emis1.txt`, `emis2.txt` etc. while `'./output/{name}.emis.txt'` creates `loans1.emis.txt`, `loans2.emis.txt` etc.
+# * To avoid creating millions of futures at once when processing a very large number of files, at most `max_in_flight` files are submitted to the pool at any time. We use `wait` with `FIRST_COMPLETED` to wait for a file to finish before submitting the next one.
+# * If processing a file fails, the error is recorded and the remaining files are processed as usual.
+# * The function returns a summary with the number of files and rows processed, the time taken, the number of rows processed per second and the errors encountered.
+
+# In[ ]:
+
+
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+def process_files(inputs, output_pattern, workers=None, max_in_flight=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    
+    summary = {'files': 0, 'rows': 0, 'errors': {}}
+    start_time = time.perf_counter()
+    
+    def collect(done):
+        for future in done:
+            input_path = in_flight.pop(future)
+            summary['files'] += 1
+            try:
+                summary['rows'] += future.result()
+            except Exception as e:
+                summary['errors'][input_path] = '{}: {}'.format(type(e).__name__, e)
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        for i, input_path in enumerate(inputs, start=1):
+            # Wait for a file to finish if too many are being processed
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            name = os.path.splitext(os.path.basename(input_path))[0]
+            output_path = output_pattern.format(i, name=name)
+            in_flight[executor.submit(process_file, input_path, output_path)] = input_path
+        # Wait for the remaining files
+        collect(wait(in_flight).done)
+    
+    summary['seconds'] = time.perf_counter() - start_time
+    summary['rows_per_second'] = summary['rows'] / summary['seconds'] if summary['seconds'] else 0.0
+    return summary
+
+
+# Let's use it to process the three files we downloaded earlier. We'll also include a file that doesn't exist, to see how errors are reported.
+
+# In[ ]:
+
+
+inputs = ['./data/loans{}.txt'.format(i) for i in range(1,4)] + ['./data/loans4.txt']
+process_files(inputs, './data/emis{}.txt', workers=2)
+
+
+# In[ ]:
+
+
+with open('./data/emis3.txt', 'r') as f:
+    print(f.read())
+
+
+# For just three small files, starting the worker processes takes longer than processing the files. The benefit of using multiple processes becomes apparent when you're processing thousands of files.
+# 
+# > **Note**: On Windows and macOS, worker processes start with a fresh Python interpreter and can't use functions defined inside a Jupyter notebook. To use `process_files` there, place the functions in a `.py` file and import them, and call `process_files` inside an `if __name__ == '__main__':` block.
+
+# ### Parsing a single large file in parallel
+# 
+# `process_files` helps when there are many files, but a single file is still processed by just one CPU core. To read one very large file using several processes, we can split it into *chunks*: ranges of bytes that can be parsed independently.
+# 
+# The chunks must start and end at the beginning of a line, otherwise a line would be split between two chunks. The function `find_chunks` opens the file in binary mode (`'rb'`) so that we can jump to any byte position using `seek`. After jumping to the approximate end of a chunk, it calls `readline` to move forward to the end of the current line. The position returned by `tell` is then used as the end of the chunk (and the start of the next one).
+
+# In[ ]:
+
+
+import io
+from itertools import repeat
+
+def find_chunks(path, chunk_size):
+    chunks = []
+    with open(path, 'rb') as f:
+        # Skip the header
+        f.readline()
+        start = f.tell()
+        size = os.path.getsize(path)
+        while start < size:
+            # Jump ahead & move forward to the end of the line
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = f.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+# In[ ]:
+
+
+find_chunks('./data/loans1.txt', 100)
+
+
+# Each chunk is parsed in a worker process by `parse_chunk`, which reads the bytes of the chunk and converts them back into lines of text using `io.TextIOWrapper` (this is what `open` does internally in text mode, so the lines are exactly the same as the ones `iter_csv` would see). Each line is then parsed using the same `parse_values` and `create_item_dict` functions as before.
+
+# In[ ]:
+
+
+def parse_chunk(path, start, end, headers):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = io.TextIOWrapper(io.BytesIO(data))
+    return [create_item_dict(parse_values(data_line), headers) for data_line in lines]
+
+
+# Finally, let's add the arguments `workers` and `chunk_size` to `read_csv`. With the default `workers=1`, the file is read as before. Otherwise, the chunks are parsed using a `ProcessPoolExecutor`. The `map` method of the executor returns the results in the same order as the chunks, so the rows are combined in the same order as in the file.
+
+# In[ ]:
+
+
+def read_csv(path, workers=1, chunk_size=16*1024*1024):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        return list(iter_csv(path))
+    
+    # Parse the header
+    with open(path, 'r') as f:
+        header_line = f.readline()
+    if header_line == '':
+        return []
+    headers = parse_headers(header_line)
+    
+    # Small files aren't worth splitting
+    chunks = find_chunks(path, chunk_size)
+    if len(chunks) <= 1:
+        return list(iter_csv(path))
+    
+    # Parse the chunks in parallel & combine the results in order
+    result = []
+    starts, ends = zip(*chunks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for rows in executor.map(parse_chunk, repeat(path), starts, ends, repeat(headers)):
+            result.extend(rows)
+    return result
+
+
+# Let's verify that we get the same result using a very small chunk size.
+
+# In[ ]:
+
+
+read_csv('./data/loans1.txt', workers=2, chunk_size=100) == read_csv('./data/loans1.txt')
+
+
+# For a large file, a chunk size of a few megabytes works well. Keep in mind that the parsed rows have to be sent back from the worker processes to the main process, which takes some time too, so the speedup will be smaller than the number of workers.
+
+# ### Reading a file using memory mapping
+# 
+# When a file is opened in text mode, Python reads its bytes and *decodes* them into a string, and `parse_values` then splits every line and converts every value, even if we only need a couple of columns.
+# 
+# The [`mmap`](https://docs.python.org/3/library/mmap.html) module can *map* a file into memory: the file's contents can be accessed like a `bytes` object, and the operating system loads the parts of the file that are accessed directly from its cache, without copying the whole file into a buffer first. We can then work with the raw bytes of each line and only decode or convert the fields we actually need. The built-in `float` function also accepts bytes, so numbers never have to be decoded into strings.
+# 
+# The function `iter_csv_mmap` works like `iter_csv`, but accepts an optional list of `columns` to return. Each field is converted using the same rules as `parse_values`: empty values become `0.0`, and values that aren't numbers are decoded into strings.
+
+# In[ ]:
+
+
+import mmap
+
+def iter_csv_mmap(path, columns=None):
+    with open(path, 'rb') as f:
+        # Empty files can't be memory-mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            # Parse the header & find the positions of the required columns
+            headers = parse_headers(m.readline().decode())
+            if columns is None:
+                columns = headers
+            indices = [headers.index(column) for column in columns]
+            # Read the remaining lines as bytes
+            for data_line in iter(m.readline, b''):
+                fields = data_line.strip().split(b',')
+                item = {}
+                for column, i in zip(columns, indices):
+                    # Skip values missing at the end of the line
+                    if i >= len(fields):
+                        continue
+                    field = fields[i]
+                    if field == b'':
+                        item[column] = 0.0
+                    else:
+                        try:
+                            item[column] = float(field)
+                        except ValueError:
+                            item[column] = field.decode()
+                yield item
+
+
+# In[ ]:
+
+
+for loan in iter_csv_mmap('./data/loans2.txt', columns=['amount', 'rate']):
+    print(loan)
+
+
+# Without the `columns` argument, `iter_csv_mmap` returns the same rows as `iter_csv`.
+
+# In[ ]:
+
+
+list(iter_csv_mmap('./data/loans3.txt')) == read_csv('./data/loans3.txt')
+
+
+# Memory mapping works best for large files that have been read recently (and are therefore present in the operating system's cache), or when only a few of the columns are needed.
+
+# ### Parsing values without exceptions
+# 
+# The `parse_values` function tries to convert every value into a `float`, and relies on catching a `ValueError` for values that aren't numbers. Raising and catching an exception is quite slow in Python, and for a column containing text it happens on every single line.
+# 
+# Since every line of a CSV file usually contains the same kind of data in each column, we can look at the first few lines of the file once, decide how each column should be converted, and then use a *converter* function for each column:
+# 
+# * `parse_number` is used for columns that contain only numbers (or empty values). It calls `float` directly.
+# * `parse_value` is used for all other columns. It only tries to convert a value into a `float` if the value starts with a character that a number can start with (a digit, a sign, a decimal point or a space) or is one of the special values `inf`, `infinity` and `nan` accepted by `float`. Any other value is returned as it is, without raising an exception.
+# 
+# Both functions return exactly the same values as `parse_values`.
+
+# In[ ]:
+
+
+from itertools import islice, chain
+
+SPECIAL_FLOATS = {'inf', 'infinity', 'nan'}
+
+def parse_number(item):
+    if item == '':
+        return 0.0
+    return float(item)
+
+def parse_value(item):
+    if item == '':
+        return 0.0
+    first = item[0]
+    if first.isdigit() or first in '+-.' or first.isspace() or item.strip().lower() in SPECIAL_FLOATS:
+        try:
+            return float(item)
+        except ValueError:
+            pass
+    return item
+
+
+# The function `infer_converters` picks a converter for each column using a sample of lines.
+
+# In[ ]:
+
+
+def infer_converters(sample_lines, num_columns):
+    numeric = [True] * num_columns
+    for data_line in sample_lines:
+        items = data_line.strip().split(',')
+        for i, item in enumerate(items[:num_columns]):
+            if type(parse_value(item)) is not float:
+                numeric[i] = False
+    return [parse_number if is_numeric else parse_value for is_numeric in numeric]
+
+
+# In[ ]:
+
+
+with open('./data/loans1.txt', 'r') as f:
+    loans1_headers = parse_headers(f.readline())
+    loans1_sample = list(islice(f, 100))
+
+
+# In[ ]:
+
+
+infer_converters(loans1_sample, len(loans1_headers))
+
+
+# In[ ]:
+
+
+infer_converters(file3_lines[1:], len(headers))
+
+
+# The function `make_line_parser` uses the converters to create a function for parsing a line, which can be used in place of `parse_values`. To avoid calling a function for every value, the numeric columns are converted directly using `float`, and `parse_value` is only called for the other columns.
+# 
+# A line that doesn't match what we saw in the sample (e.g. a line with a different number of values, or a column containing a text value further down the file) is simply parsed using `parse_values`. The `try` statement costs almost nothing when no exception is raised.
+
+# In[ ]:
+
+
+def make_line_parser(converters):
+    num_columns = len(converters)
+    numeric_columns = [i for i, convert in enumerate(converters) if convert is parse_number]
+    other_columns = [i for i, convert in enumerate(converters) if convert is not parse_number]
+    
+    def parse_line(data_line):
+        items = data_line.strip().split(',')
+        if len(items) == num_columns:
+            try:
+                for i in numeric_columns:
+                    item = items[i]
+                    items[i] = float(item) if item else 0.0
+                for i in other_columns:
+                    items[i] = converters[i](items[i])
+                return items
+            except ValueError:
+                pass
+        # Fall back to parsing lines that don't match the sample
+        return parse_values(data_line)
+    
+    return parse_line
+
+
+# For a file that contains only numbers, we can skip the sampling altogether and convert all the values in a line using a single list comprehension.
+
+# In[ ]:
+
+
+def parse_numeric_line(data_line):
+    return [float(item) if item else 0.0 for item in data_line.strip().split(',')]
+
+
+# Finally, let's update `iter_csv` to infer the converters from the first `sample_size` lines. The sample lines are then processed along with the rest of the file using `chain`.
+# 
+# If you know that a file contains only numbers, you can also pass `strict=True`, which skips the sampling and parses every line using `parse_numeric_line`. In this mode, a value that isn't a number raises a `ValueError` instead of being returned as a string.
+
+# In[ ]:
+
+
+def iter_csv(path, sample_size=100, strict=False):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header (an empty file has no rows)
+        header_line = f.readline()
+        if header_line == '':
+            return
+        headers = parse_headers(header_line)
+        # Choose how to parse the lines
+        if strict:
+            parse_line = parse_numeric_line
+            lines = f
+        else:
+            sample = list(islice(f, sample_size))
+            parse_line = make_line_parser(infer_converters(sample, len(headers)))
+            lines = chain(sample, f)
+        # Parse the lines one by one
+        for data_line in lines:
+            yield create_item_dict(parse_line(data_line), headers)
+
+
+# Since `read_csv` uses `iter_csv`, it uses the new parser automatically. Let's verify that the results haven't changed.
+
+# In[ ]:
+
+
+read_csv('./data/loans3.txt')
+
+
+# In[ ]:
+
+
+read_csv('./data/loans3.txt') == [create_item_dict(parse_values(data_line), headers) for data_line in file3_lines[1:]]
+
+
+# In[ ]:
+
+
+list(iter_csv('./data/loans2.txt', strict=True))
+
+
+# ### Using records instead of dictionaries for rows
+# 
+# Each row returned by `read_csv` is a dictionary. Dictionaries are very flexible, but they use a lot of memory, since every dictionary stores its own hash table of keys. All the rows of a CSV file have the same keys, so we can use a more compact representation for them:
+# 
+# * A class with [`__slots__`](https://docs.python.org/3/reference/datamodel.html#slots) stores a fixed set of attributes in the object itself (without a dictionary), and its values can be modified.
+# * A [`namedtuple`](https://docs.python.org/3/library/collections.html#collections.namedtuple) from the `collections` module creates a tuple whose values can also be accessed as attributes. Tuples can't be modified after they are created.
+# 
+# The function `make_record_class` creates a new *record class* for a list of fields, which must be valid Python identifiers (e.g. `down_payment`, but not `down payment`). Missing values at the end of a line are left unset in a `__slots__` record, and are set to the empty string `''` in a `namedtuple` record.
+
+# In[ ]:
+
+
+import keyword
+from collections import namedtuple
+from functools import partial
+
+def record_init(self, *values):
+    for field, value in zip(self.__slots__, values):
+        setattr(self, field, value)
+
+def record_repr(self):
+    values = ['{}={!r}'.format(field, getattr(self, field)) for field in self.__slots__ if hasattr(self, field)]
+    return '{}({})'.format(type(self).__name__, ', '.join(values))
+
+def record_eq(self, other):
+    if getattr(type(other), '__slots__', None) != self.__slots__:
+        return NotImplemented
+    return all(getattr(self, field, '') == getattr(other, field, '') for field in self.__slots__)
+
+def make_record_class(fields, kind='slots'):
+    fields = tuple(fields)
+    for field in fields:
+        if not field.isidentifier() or keyword.iskeyword(field):
+            raise ValueError('Field names must be valid identifiers: {!r}'.format(field))
+    if kind == 'namedtuple':
+        return namedtuple('Record', fields, defaults=[''] * len(fields))
+    if kind == 'slots':
+        namespace = {'__slots__': fields, '__init__': record_init, '__repr__': record_repr, '__eq__': record_eq}
+        return type('Record', (), namespace)
+    raise ValueError("kind must be 'slots' or 'namedtuple', not {!r}".format(kind))
+
+
+# In[ ]:
+
+
+LoanRecord = make_record_class(['amount', 'duration', 'rate', 'down_payment'])
+loan = LoanRecord(100000.0, 36.0, 0.08, 20000.0)
+loan
+
+
+# In[ ]:
+
+
+loan.amount, loan.rate
+
+
+# Let's compare the memory used by a record with that of a dictionary containing the same values.
+
+# In[ ]:
+
+
+loan_dict = {'amount': 100000.0, 'duration': 36.0, 'rate': 0.08, 'down_payment': 20000.0}
+sys.getsizeof(loan_dict), sys.getsizeof(loan)
+
+
+# The function `record_factory` returns a function that creates a record from a list of values returned by `parse_values` (playing the role of `create_item_dict`). We can now add an argument `record` to `iter_csv`, which can be set to `'slots'` or `'namedtuple'` to return records instead of dictionaries.
+
+# In[ ]:
+
+
+def record_factory(headers, kind):
+    record_class = make_record_class(headers, kind)
+    if kind == 'namedtuple':
+        # Ignore extra values at the end of a line (like create_item_dict)
+        num_fields = len(headers)
+        return lambda values: record_class(*values[:num_fields])
+    return lambda values: record_class(*values)
+
+def iter_csv(path, sample_size=100, strict=False, record=None):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header (an empty file has no rows)
+        header_line = f.readline()
+        if header_line == '':
+            return
+        headers = parse_headers(header_line)
+        # Choose how to parse the lines
+        if strict:
+            parse_line = parse_numeric_line
+            lines = f
+        else:
+            sample = list(islice(f, sample_size))
+            parse_line = make_line_parser(infer_converters(sample, len(headers)))
+            lines = chain(sample, f)
+        # Choose how to create the rows
+        if record is None:
+            create_item = partial(create_item_dict, headers=headers)
+        else:
+            create_item = record_factory(headers, record)
+        # Parse the lines one by one
+        for data_line in lines:
+            yield create_item(parse_line(data_line))
+
+
+# Record classes are created while the program is running, so they can't be sent between processes. When reading a file in parallel with records, the worker processes return the parsed values, and the records are created in the main process.
+
+# In[ ]:
+
+
+def parse_chunk(path, start, end, headers, record=None):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = io.TextIOWrapper(io.BytesIO(data))
+    if record is not None:
+        return [parse_values(data_line) for data_line in lines]
+    return [create_item_dict(parse_values(data_line), headers) for data_line in lines]
+
+def read_csv(path, workers=1, chunk_size=16*1024*1024, record=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        return list(iter_csv(path, record=record))
+    
+    # Parse the header
+    with open(path, 'r') as f:
+        header_line = f.readline()
+    if header_line == '':
+        return []
+    headers = parse_headers(header_line)
+    
+    # Small files aren't worth splitting
+    chunks = find_chunks(path, chunk_size)
+    if len(chunks) <= 1:
+        return list(iter_csv(path, record=record))
+    
+    # Parse the chunks in parallel & combine the results in order
+    result = []
+    starts, ends = zip(*chunks)
+    if record is not None:
+        create_item = record_factory(headers, record)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for rows in executor.map(parse_chunk, repeat(path), starts, ends, repeat(headers), repeat(record)):
+            if record is not None:
+                rows = map(create_item, rows)
+            result.extend(rows)
+    return result
+
+
+# In[ ]:
+
+
+read_csv('./data/loans2.txt', record='slots')
+
+
+# In[ ]:
+
+
+read_csv('./data/loans2.txt', record='namedtuple')
+
+
+# Next, let's update `compute_emis` and `write_csv` to work with records as well as dictionaries.
+# 
+# A record can't gain a new field like `emi`. If the record class doesn't already have the field, `with_field` creates an *extended* record class with the additional field (just once for each combination of fields), and returns a copy of the record with the new field. For this reason, `compute_emis` replaces the records in the list instead of modifying them.
+
+# In[ ]:
+
+
+EXTENDED_RECORD_CLASSES = {}
+
+def record_fields(record_class):
+    if issubclass(record_class, tuple):
+        return record_class._fields
+    return record_class.__slots__
+
+def with_field(record, field, value):
+    record_class = type(record)
+    fields = record_fields(record_class)
+    is_namedtuple = issubclass(record_class, tuple)
+    
+    # Update the field if it already exists
+    if field in fields:
+        if is_namedtuple:
+            return record._replace(**{field: value})
+        setattr(record, field, value)
+        return record
+    
+    # Otherwise, create a copy using an extended record class
+    # Each call to `read_csv` creates a new record class, so the extended classes
+    # are shared by all record classes with the same fields
+    kind = 'namedtuple' if is_namedtuple else 'slots'
+    key = (fields, kind, field)
+    if key not in EXTENDED_RECORD_CLASSES:
+        EXTENDED_RECORD_CLASSES[key] = make_record_class(fields + (field,), kind)
+    extended_class = EXTENDED_RECORD_CLASSES[key]
+    if is_namedtuple:
+        return extended_class(*record, value)
+    new_record = extended_class()
+    for name in fields:
+        if hasattr(record, name):
+            setattr(new_record, name, getattr(record, name))
+    setattr(new_record, field, value)
+    return new_record
+
+def compute_emis(loans):
+    for i, loan in enumerate(loans):
+        if isinstance(loan, dict):
+            loan['emi'] = loan_emi(
+                loan['amount'], 
+                loan['duration'], 
+                loan['rate']/12, # the CSV contains yearly rates
+                loan['down_payment'])
+        else:
+            emi = loan_emi(loan.amount, loan.duration, loan.rate/12, loan.down_payment)
+            loans[i] = with_field(loan, 'emi', emi)
+
+
+# In[ ]:
+
+
+def write_csv(items, path):
+    # Open the file in write mode
+    with open(path, 'w') as f:
+        # Return if there's nothing to write
+        if len(items) == 0:
+            return
+        
+        # Write the headers in the first line
+        if isinstance(items[0], dict):
+            headers = list(items[0].keys())
+        else:
+            headers = list(record_fields(type(items[0])))
+        f.write(','.join(headers) + '\n')
+        
+        # Write one item per line
+        for item in items:
+            values = []
+            for header in headers:
+                if isinstance(item, dict):
+                    values.append(str(item.get(header, "")))
+                else:
+                    values.append(str(getattr(item, header, "")))
+            f.write(','.join(values) + "\n")
+
+
+# In[ ]:
+
+
+loans3_records = read_csv('./data/loans3.txt', record='slots')
+compute_emis(loans3_records)
+loans3_records[:3]
+
+
+# In[ ]:
+
+
+write_csv(loans3_records, './data/emis3.txt')
+
+
+# In[ ]:
+
+
+with open('./data/emis3.txt', 'r') as f:
+    print(f.read())
+
+
+# ### Writing files in batches
+# 
+# The `write_csv` function calls `f.write` once for every row, and for every row it loops over the headers to build a list of values. We can make it faster in a few ways:
+# 
+# * **Precompiled formatters**: We can create a function for formatting a row just once. It uses `itemgetter` (or `attrgetter` for records) from the [`operator`](https://docs.python.org/3/library/operator.html) module to fetch all the values of a row in a single call, and a *template* string like `'%s,%s,%s,%s'` to format all the values with a single `%` operation (`%s` formats a value the same way as `str`). Optionally, a dictionary `formats` can specify a different format for a column (e.g. `'%.2f'` for 2 decimal places).
+# * **Batching**: Instead of writing each line separately, we can collect `batch_size` lines in a list, join them into one large string and write it with a single call to `f.write`.
+# * **Buffering**: The `buffering` argument of `open` sets the size (in bytes) of the buffer used to collect the data before it's actually written to the disk.
+# 
+# We'll also allow `items` to be any *iterable* (e.g. a generator) instead of just a list, so that rows can be written as soon as they are produced. The `mode` argument can be set to `'a'` to add rows to the end of an existing file (the header is only written if the file is empty). `write_csv` now also returns the number of rows written.
+
+# In[ ]:
+
+
+from operator import itemgetter, attrgetter
+
+def make_row_formatter(headers, is_dict, formats=None):
+    if formats is None:
+        formats = {}
+    column_formats = [formats.get(header, '%s') for header in headers]
+    template = ','.join(column_formats)
+    getter = (itemgetter if is_dict else attrgetter)(*headers)
+    
+    def format_row(item):
+        try:
+            values = getter(item)
+        except (KeyError, AttributeError):
+            # Missing values are written as empty strings
+            if is_dict:
+                return ','.join([column_format % (item[header],) if header in item else '' 
+                                 for column_format, header in zip(column_formats, headers)])
+            return ','.join([column_format % (getattr(item, header),) if hasattr(item, header) else '' 
+                             for column_format, header in zip(column_formats, headers)])
+        if len(headers) == 1:
+            values = (values,)
+        return template % values
+    
+    return format_row
+
+
+# In[ ]:
+
+
+LoanRecord = make_record_class(['amount', 'duration', 'rate', 'down_payment'])
+format_loan = make_row_formatter(['amount', 'duration', 'rate', 'down_payment'], is_dict=False, formats={'rate': '%.3f'})
+format_loan(LoanRecord(100000.0, 36.0, 0.08, 20000.0))
+
+
+# In[ ]:
+
+
+def write_csv(items, path, mode='w', formats=None, batch_size=1000, buffer_size=1024*1024):
+    count = 0
+    # Open the file in write (or append) mode
+    with open(path, mode, buffering=buffer_size) as f:
+        # Return if there's nothing to write
+        items = iter(items)
+        first_item = next(items, None)
+        if first_item is None:
+            return count
+        
+        # Write the headers in the first line (unless we're appending to a file)
+        is_dict = isinstance(first_item, dict)
+        if is_dict:
+            headers = list(first_item.keys())
+        else:
+            headers = list(record_fields(type(first_item)))
+        if f.tell() == 0:
+            f.write(','.join(headers) + '\n')
+        
+        # Write the items in batches
+        format_row = make_row_formatter(headers, is_dict, formats)
+        batch = [format_row(first_item)]
+        for item in items:
+            batch.append(format_row(item))
+            if len(batch) >= batch_size:
+                f.write('\n'.join(batch) + '\n')
+                count += len(batch)
+                batch = []
+        if batch:
+            f.write('\n'.join(batch) + '\n')
+            count += len(batch)
+    return count
+
+
+# To take advantage of streaming, let's also define a generator `iter_emis`, which computes the EMI for each loan as it's read. `compute_emis` can then simply replace the contents of the list with the results of `iter_emis`.
+
+# In[ ]:
+
+
+def iter_emis(loans):
+    for loan in loans:
+        if isinstance(loan, dict):
+            loan['emi'] = loan_emi(
+                loan['amount'], 
+                loan['duration'], 
+                loan['rate']/12, # the CSV contains yearly rates
+                loan['down_payment'])
+            yield loan
+        else:
+            emi = loan_emi(loan.amount, loan.duration, loan.rate/12, loan.down_payment)
+            yield with_field(loan, 'emi', emi)
+
+def compute_emis(loans):
+    loans[:] = iter_emis(loans)
+
+
+# We can now read, process and write a file one row at a time, without ever holding the entire file in memory.
+
+# In[ ]:
+
+
+write_csv(iter_emis(iter_csv('./data/loans1.txt')), './data/emis1.txt')
+
+
+# In[ ]:
+
+
+with open('./data/emis1.txt', 'r') as f:
+    print(f.read())
+
+
+# Here's how we can use `formats` to control how the values are written, and `mode='a'` to add the loans from another file to the end of the same file.
+
+# In[ ]:
+
+
+emi_formats = {'amount': '%.0f', 'duration': '%.0f', 'down_payment': '%.0f'}
+write_csv(iter_emis(iter_csv('./data/loans2.txt')), './data/emis_all.txt', formats=emi_formats)
+write_csv(iter_emis(iter_csv('./data/loans3.txt')), './data/emis_all.txt', mode='a', formats=emi_formats)
+
+
+# In[ ]:
+
+
+with open('./data/emis_all.txt', 'r') as f:
+    print(f.read())
+
+
+# ### Reading and writing quoted values without Pandas
+# 
+# Earlier, we used Pandas to read & write `movies.csv`, because our `read_csv` and `write_csv` functions don't handle values containing commas. Pandas is a large library and takes a while to import, so let's add support for quoted values to our own functions instead. The rules for quoting values in CSV files are described in [RFC 4180](https://datatracker.ietf.org/doc/html/rfc4180):
+# 
+# * A value containing commas, double quotes or line breaks is enclosed in double quotes, e.g. `"A movie, a race, a franchise"`.
+# * A double quote inside a quoted value is written as two double quotes, e.g. `"Gotham, the ""Batman"", and the Joker"`.
+# * Since a quoted value can contain line breaks, a single row can span multiple lines of the file.
+# 
+# Splitting such lines correctly requires a *tokenizer*: a small state machine that reads a line character by character and keeps track of whether it's currently inside a quoted value. Doing this in a Python loop would be quite slow, but Python's built-in [`csv`](https://docs.python.org/3/library/csv.html) module contains exactly such a tokenizer, written in C. Unlike Pandas, it's part of the standard library and takes almost no time to import.
+# 
+# The function `split_quoted_line` uses `csv.reader` to split a single line (or row) into a list of values.
+
+# In[ ]:
+
+
+import csv
+
+def split_quoted_line(data_line):
+    return next(csv.reader([data_line]))
+
+
+# In[ ]:
+
+
+split_quoted_line('The Dark Knight,"Gotham, the ""Batman"", and the Joker"')
+
+
+# Next, let's update `parse_headers` and `parse_values` to use `split_quoted_line`, but only for lines that actually contain a double quote. All other lines are processed exactly as before. We'll also update `make_line_parser` to split lines containing quotes using `split_quoted_line`, so that the values can still be converted using the converters for each column.
+
+# In[ ]:
+
+
+def parse_headers(header_line):
+    if '"' in header_line:
+        return split_quoted_line(header_line.strip())
+    return header_line.strip().split(',')
+
+def parse_values(data_line):
+    if '"' in data_line:
+        return [parse_value(item) for item in split_quoted_line(data_line.strip())]
+    values = []
+    for item in data_line.strip().split(','):
+        if item == '':
+            values.append(0.0)
+        else:
+            try:
+                values.append(float(item))
+            except ValueError:
+                values.append(item)
+    return values
+
+def make_line_parser(converters):
+    num_columns = len(converters)
+    numeric_columns = [i for i, convert in enumerate(converters) if convert is parse_number]
+    other_columns = [i for i, convert in enumerate(converters) if convert is not parse_number]
+    
+    def parse_line(data_line):
+        if '"' in data_line:
+            items = split_quoted_line(data_line.strip())
+        else:
+            items = data_line.strip().split(',')
+        if len(items) == num_columns:
+            try:
+                for i in numeric_columns:
+                    item = items[i]
+                    items[i] = float(item) if item else 0.0
+                for i in other_columns:
+                    items[i] = converters[i](items[i])
+                return items
+            except ValueError:
+                pass
+        # Fall back to parsing lines that don't match the sample
+        return parse_values(data_line)
+    
+    return parse_line
+
+
+# To handle rows spanning multiple lines, `iter_csv` uses `read_record` to keep adding lines to a row while it contains an unclosed quoted value (an odd number of double quotes). `infer_converters` also needs a small change, to split the sample lines containing quotes using `split_quoted_line`.
+
+# In[ ]:
+
+
+def read_record(data_line, lines):
+    while data_line.count('"') % 2 == 1:
+        next_line = next(lines, None)
+        if next_line is None:
+            break
+        data_line += next_line
+    return data_line
+
+def infer_converters(sample_lines, num_columns):
+    numeric = [True] * num_columns
+    for data_line in sample_lines:
+        if '"' in data_line:
+            items = split_quoted_line(data_line.strip())
+        else:
+            items = data_line.strip().split(',')
+        for i, item in enumerate(items[:num_columns]):
+            if type(parse_value(item)) is not float:
+                numeric[i] = False
+    return [parse_number if is_numeric else parse_value for is_numeric in numeric]
+
+def iter_csv(path, sample_size=100, strict=False, record=None):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        # Parse the header (an empty file has no rows)
+        header_line = f.readline()
+        if header_line == '':
+            return
+        headers = parse_headers(header_line)
+        # Choose how to parse the lines
+        if strict:
+            parse_line = parse_numeric_line
+            lines = f
+        else:
+            sample = list(islice(f, sample_size))
+            parse_line = make_line_parser(infer_converters(sample, len(headers)))
+            lines = chain(sample, f)
+        # Choose how to create the rows
+        if record is None:
+            create_item = partial(create_item_dict, headers=headers)
+        else:
+            create_item = record_factory(headers, record)
+        # Parse the lines one by one
+        for data_line in lines:
+            # Rows with quoted values can span multiple lines
+            if '"' in data_line and data_line.count('"') % 2 == 1:
+                data_line = read_record(data_line, lines)
+            yield create_item(parse_line(data_line))
+
+
+# Let's try reading `movies.csv` again.
+
+# In[ ]:
+
+
+movies = read_csv('data/movies.csv')
+movies
+
+
+# For writing, a value needs to be quoted if it contains a comma, a double quote or a line break. To avoid checking every value, the row formatter first formats the row as before, and then checks the entire row: if the row contains any double quotes or line breaks, or more commas than there are separators between the values, the values are formatted and quoted one by one.
+
+# In[ ]:
+
+
+def quote_value(text):
+    if ',' in text or '"' in text or '\n' in text or '\r' in text:
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+def make_row_formatter(headers, is_dict, formats=None):
+    if formats is None:
+        formats = {}
+    column_formats = [formats.get(header, '%s') for header in headers]
+    template = ','.join(column_formats)
+    num_separators = len(headers) - 1
+    getter = (itemgetter if is_dict else attrgetter)(*headers)
+    
+    def format_values(item):
+        # Missing values are written as empty strings
+        if is_dict:
+            return [column_format % (item[header],) if header in item else '' 
+                    for column_format, header in zip(column_formats, headers)]
+        return [column_format % (getattr(item, header),) if hasattr(item, header) else '' 
+                for column_format, header in zip(column_formats, headers)]
+    
+    def format_row(item):
+        try:
+            values = getter(item)
+        except (KeyError, AttributeError):
+            return ','.join(map(quote_value, format_values(item)))
+        if len(headers) == 1:
+            values = (values,)
+        row = template % values
+        # Quote the values if required
+        if '"' in row or '\n' in row or '\r' in row or row.count(',') != num_separators:
+            return ','.join(map(quote_value, format_values(item)))
+        return row
+    
+    return format_row
+
+
+# The headers are quoted in the same way in `write_csv`.
+
+# In[ ]:
+
+
+def write_csv(items, path, mode='w', formats=None, batch_size=1000, buffer_size=1024*1024):
+    count = 0
+    # Open the file in write (or append) mode
+    with open(path, mode, buffering=buffer_size) as f:
+        # Return if there's nothing to write
+        items = iter(items)
+        first_item = next(items, None)
+        if first_item is None:
+            return count
+        
+        # Write the headers in the first line (unless we're appending to a file)
+        is_dict = isinstance(first_item, dict)
+        if is_dict:
+            headers = list(first_item.keys())
+        else:
+            headers = list(record_fields(type(first_item)))
+        if f.tell() == 0:
+            f.write(','.join(map(quote_value, headers)) + '\n')
+        
+        # Write the items in batches
+        format_row = make_row_formatter(headers, is_dict, formats)
+        batch = [format_row(first_item)]
+        for item in items:
+            batch.append(format_row(item))
+            if len(batch) >= batch_size:
+                f.write('\n'.join(batch) + '\n')
+                count += len(batch)
+                batch = []
+        if batch:
+            f.write('\n'.join(batch) + '\n')
+            count += len(batch)
+    return count
+
+
+# In[ ]:
+
+
+write_csv(movies, 'movies2.csv')
+
+
+# In[ ]:
+
+
+with open('movies2.csv', 'r') as f:
+    print(f.read())
+
+
+# In[ ]:
+
+
+read_csv('movies2.csv') == movies
+
+
+# Note that `iter_csv_mmap` and the parallel version of `read_csv` (with `workers` greater than 1) split the file at line breaks, so they can't be used for files containing quoted values with line breaks.
+
+# ### Caching EMI calculations
+# 
+# Loans often share the same terms: a bank may offer just a few rates of interest and durations, and many loans have the same amount and down payment. For such loans, `loan_emi` computes the same power `(1+rate)**duration` (and often the same EMI) over and over again.
+# 
+# We can avoid repeating these calculations by storing the results in a *cache*, which maps the arguments of a function to its result. To keep the cache from growing forever, it has a maximum size (`maxsize`). When the cache is full, one of the results is *evicted* (removed) according to an *eviction policy*:
+# 
+# * **LRU** (least recently used) evicts the result that hasn't been used for the longest time. Python provides the [`functools.lru_cache`](https://docs.python.org/3/library/functools.html#functools.lru_cache) decorator, which is implemented in C and is very fast. The function it returns has a `cache_info` method that reports the number of *hits* (results found in the cache) and *misses* (results that had to be computed), and a `cache_clear` method to empty the cache.
+# * **LFU** (least frequently used) evicts the result that has been used the fewest times. This works better when a few terms are very common and many others appear only occasionally. There's no built-in LFU cache, so let's write one.
+# 
+# The `LFUCache` class stores the results in a dictionary, and counts how many times each result has been used. To find the least frequently used result without checking all the counts, it also groups the keys into *buckets* by count (each bucket is an `OrderedDict`, which can remove its oldest key in constant time), and tracks the smallest count. Each lookup moves a key to the next bucket, so both lookups and evictions take constant time, although they're still slower than with `lru_cache`, which is implemented in C.
+
+# In[ ]:
+
+
+from collections import OrderedDict
+from functools import lru_cache
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+MISSING = object()
+
+class LFUCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.clear()
+    
+    def clear(self):
+        self.data = {}
+        self.counts = {}
+        # The keys used exactly `count` times, from the oldest to the newest
+        self.buckets = {}
+        self.min_count = 0
+        self.hits = self.misses = 0
+    
+    def touch(self, key):
+        # Move the key to the bucket for the next count
+        count = self.counts[key]
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if self.min_count == count:
+                self.min_count = count + 1
+        self.counts[key] = count + 1
+        self.buckets.setdefault(count + 1, OrderedDict())[key] = None
+    
+    def get(self, key, default=None):
+        value = self.data.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.touch(key)
+        return value
+    
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        if key in self.data:
+            self.data[key] = value
+            self.touch(key)
+            return
+        if len(self.data) >= self.maxsize:
+            # Evict the least frequently used result (the oldest one if there's a tie)
+            bucket = self.buckets[self.min_count]
+            evicted_key, _ = bucket.popitem(last=False)
+            if not bucket:
+                del self.buckets[self.min_count]
+            del self.data[evicted_key]
+            del self.counts[evicted_key]
+        self.data[key] = value
+        self.counts[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_count = 1
+    
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data))
+
+
+# The decorator `memoize` wraps a function so that its results are looked up in an `LFUCache`, and only computed on a miss. Like `lru_cache`, it adds the methods `cache_info` and `cache_clear` to the function.
+
+# In[ ]:
+
+
+def memoize(cache):
+    def decorator(func):
+        def wrapper(*args):
+            value = cache.get(args, MISSING)
+            if value is MISSING:
+                value = func(*args)
+                cache.put(args, value)
+            return value
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+
+# The function `make_cached_loan_emi` returns a version of `loan_emi` with two caches: one for the power `(1+rate)**duration` (keyed on the rate and duration), and one for the EMIs (keyed on all four arguments). The formula is evaluated in exactly the same order as in `loan_emi`, so the results are identical. The sizes of the caches and the eviction policy (`'lru'` or `'lfu'`) for the EMIs can be configured.
+
+# In[ ]:
+
+
+def make_cached_loan_emi(maxsize=100000, policy='lru', factor_maxsize=10000):
+    @lru_cache(maxsize=factor_maxsize)
+    def growth_factor(rate, duration):
+        return (1+rate)**duration
+    
+    def emi_with_cached_factor(amount, duration, rate, down_payment=0):
+        loan_amount = amount - down_payment
+        factor = growth_factor(rate, duration)
+        try:
+            emi = loan_amount * rate * factor / (factor-1)
+        except ZeroDivisionError:
+            emi = loan_amount / duration
+        emi = math.ceil(emi)
+        return emi
+    
+    if policy == 'lru':
+        cached_loan_emi = lru_cache(maxsize=maxsize)(emi_with_cached_factor)
+    elif policy == 'lfu':
+        cached_loan_emi = memoize(LFUCache(maxsize))(emi_with_cached_factor)
+    else:
+        raise ValueError("policy must be 'lru' or 'lfu', not {!r}".format(policy))
+    cached_loan_emi.growth_factor = growth_factor
+    return cached_loan_emi
+
+cached_loan_emi = make_cached_loan_emi()
+
+
+# Finally, `iter_emis` (and therefore `compute_emis`) can use `cached_loan_emi` instead of `loan_emi`. To use different cache settings, simply replace `cached_loan_emi`, e.g. `cached_loan_emi = make_cached_loan_emi(maxsize=1000, policy='lfu')`.
+
+# In[ ]:
+
+
+def iter_emis(loans):
+    for loan in loans:
+        if isinstance(loan, dict):
+            loan['emi'] = cached_loan_emi(
+                loan['amount'], 
+                loan['duration'], 
+                loan['rate']/12, # the CSV contains yearly rates
+                loan['down_payment'])
+            yield loan
+        else:
+            emi = cached_loan_emi(loan.amount, loan.duration, loan.rate/12, loan.down_payment)
+            yield with_field(loan, 'emi', emi)
+
+
+# Let's try it out on a portfolio of 100,000 loans with a few different terms.
+
+# In[ ]:
+
+
+import random
+
+random.seed(42)
+portfolio = [{'amount': random.choice([100000.0, 250000.0, 500000.0]) + random.randrange(0, 10) * 1000, 
+              'duration': random.choice([12.0, 24.0, 36.0, 60.0, 120.0]), 
+              'rate': random.choice([0.06, 0.08, 0.1, 0.12]), 
+              'down_payment': random.choice([0.0, 10000.0, 20000.0])} 
+             for _ in range(100000)]
+
+
+# In[ ]:
+
+
+compute_emis(portfolio)
+
+
+# In[ ]:
+
+
+cached_loan_emi.cache_info(), cached_loan_emi.growth_factor.cache_info()
+
+
+# Most of the EMIs were found in the cache. Keep in mind that looking up a result in a cache isn't free: if most loans have different terms (e.g. every loan has a different amount), the cache will mostly miss, and computing the EMIs directly using `loan_emi` is faster. The hit/miss counts reported by `cache_info` can help you decide whether a cache is worthwhile for your data.
+
+# ### Looking up annuity factors in a precomputed table
+# 
+# The EMI formula can be split into two parts: the loan amount, and an *annuity factor* that depends only on the rate and the duration:
+# 
+# ```
+# emi = loan_amount * annuity_factor
+# annuity_factor = rate * (1+rate)**duration / ((1+rate)**duration - 1)
+# ```
+# 
+# If a bank offers loans on a fixed *grid* of rates and durations, we can compute the annuity factor for every combination in advance and save the table to a file. Calculating an EMI then only requires looking up the factor and a single multiplication, which is useful when EMIs are calculated again and again (e.g. every time a customer requests a quote).
+# 
+# The function `build_annuity_table` creates a dictionary mapping each `(rate, duration)` pair to its annuity factor. For a zero rate, the factor is `1 / duration`.
+
+# In[ ]:
+
+
+def build_annuity_table(rates, durations):
+    table = {}
+    for rate in rates:
+        for duration in durations:
+            factor = (1+rate)**duration
+            if factor == 1:
+                table[(rate, duration)] = 1 / duration
+            else:
+                table[(rate, duration)] = rate * factor / (factor-1)
+    return table
+
+
+# We can save the table to a CSV file (and load it back) using the functions we've already defined. Python writes floating point numbers with enough digits to read back exactly the same number, so no precision is lost.
+
+# In[ ]:
+
+
+def save_annuity_table(table, path):
+    rows = ({'rate': rate, 'duration': duration, 'factor': factor} 
+            for (rate, duration), factor in table.items())
+    return write_csv(rows, path)
+
+def load_annuity_table(path):
+    return {(row['rate'], row['duration']): row['factor'] for row in iter_csv(path)}
+
+
+# Let's build a table for rates between 1% and 20% per annum (in steps of 1%), and durations of up to 30 years. Note that the yearly rates are computed as `i / 100` (since `0.01 * 7` is actually `0.07000000000000001`) and divided by 12 in exactly the same way as in `compute_emis`, so that the keys of the table match exactly.
+
+# In[ ]:
+
+
+grid_rates = [yearly_rate / 12 for yearly_rate in [i / 100 for i in range(1, 21)]]
+grid_durations = range(1, 361)
+annuity_table = build_annuity_table(grid_rates, grid_durations)
+len(annuity_table)
+
+
+# In[ ]:
+
+
+save_annuity_table(annuity_table, './data/annuity_factors.csv')
+annuity_table = load_annuity_table('./data/annuity_factors.csv')
+
+
+# The function `table_loan_emi` looks up the annuity factor for a loan. Loans that aren't on the grid are passed on to `cached_loan_emi`, which calculates their EMIs exactly as before.
+# 
+# Multiplying by the factor rounds the result slightly differently than the full formula in `loan_emi`. This only matters when the EMI is extremely close to a whole number, where `math.ceil` could round it differently. In that (rare) case, we also fall back to the exact calculation, so the results are always the same as those of `loan_emi`.
+
+# In[ ]:
+
+
+def table_loan_emi(amount, duration, rate, down_payment=0):
+    factor = annuity_table.get((rate, duration))
+    if factor is None:
+        return cached_loan_emi(amount, duration, rate, down_payment)
+    emi = (amount - down_payment) * factor
+    # Too close to a whole number to round reliably
+    if abs(emi - round(emi)) <= 1e-9 * abs(emi):
+        return cached_loan_emi(amount, duration, rate, down_payment)
+    return math.ceil(emi)
+
+def iter_emis(loans):
+    for loan in loans:
+        if isinstance(loan, dict):
+            loan['emi'] = table_loan_emi(
+                loan['amount'], 
+                loan['duration'], 
+                loan['rate']/12, # the CSV contains yearly rates
+                loan['down_payment'])
+            yield loan
+        else:
+            emi = table_loan_emi(loan.amount, loan.duration, loan.rate/12, loan.down_payment)
+            yield with_field(loan, 'emi', emi)
+
+
+# Let's verify that the EMIs match the ones calculated using `loan_emi`.
+
+# In[ ]:
+
+
+compute_emis(portfolio)
+all(loan['emi'] == loan_emi(loan['amount'], loan['duration'], loan['rate']/12, loan['down_payment']) 
+    for loan in portfolio)
+
+
+# How much time does the lookup save? Let's compare it with `loan_emi` for the loans in the portfolio.
+
+# In[ ]:
+
+
+portfolio_terms = [(loan['amount'], loan['duration'], loan['rate']/12, loan['down_payment']) for loan in portfolio]
+
+start_time = time.perf_counter()
+for terms in portfolio_terms:
+    loan_emi(*terms)
+loan_emi_time = time.perf_counter() - start_time
+
+start_time = time.perf_counter()
+for terms in portfolio_terms:
+    table_loan_emi(*terms)
+table_loan_emi_time = time.perf_counter() - start_time
+
+loan_emi_time, table_loan_emi_time
+
+
+# Perhaps surprisingly, the lookup isn't faster! Computing a power of a floating point number takes just a few nanoseconds, which is about as long as creating the tuple `(rate, duration)` and looking it up in a dictionary. Most of the time is spent on calling functions and other Python overhead, which the table doesn't avoid. This is a good example of why it's important to *measure* before optimizing. A table of annuity factors is still useful to share exactly the same factors between different programs, or when the factors are expensive to compute (e.g. for more complicated loan products).
+# 
+# To use a different grid, build a new table (or load one from a file) and assign it to `annuity_table`. Setting `annuity_table = {}` disables the lookup.
+
+# ### Processing only the files that have changed
+# 
+# When `process_files` is run again (e.g. every night), it processes every file again, even if most of them haven't changed since the last run. We can keep track of the files we've already processed in a *manifest*: a JSON file that records, for each input file:
+# 
+# * its modification time (`mtime_ns`, in nanoseconds) and size, which can be checked quickly using `os.stat`,
+# * a *hash* of its contents computed using the [`hashlib`](https://docs.python.org/3/library/hashlib.html) module, which changes whenever the contents of the file change,
+# * the path of the output file, and
+# * a *code version*: a string that should be changed whenever the processing code changes (e.g. the EMI formula), so that all the files are processed again.
+# 
+# A file is skipped if its modification time, size, output path and code version match the manifest, and the output file exists. If only the modification time has changed (e.g. because the file was copied again), the hash of the file is compared with the one in the manifest before deciding whether to process it.
+
+# In[ ]:
+
+
+import hashlib
+import json
+
+PIPELINE_VERSION = '1'
+
+def file_fingerprint(path, block_size=1024*1024):
+    stat = os.stat(path)
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(partial(f.read, block_size), b''):
+            sha256.update(block)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha256.hexdigest()}
+
+
+# In[ ]:
+
+
+file_fingerprint('./data/loans1.txt')
+
+
+# The manifest is loaded and saved using the `json` module. To avoid leaving behind a broken manifest if the program is interrupted while saving it, it's first written to a temporary file, which then replaces the old manifest using `os.replace`.
+
+# In[ ]:
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {'files': {}}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, path):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, path)
+
+
+# The function `update_file` runs in a worker process. It computes the fingerprint of the input file *before* reading it (so that changes made while the file is being processed are detected on the next run), and skips processing it if its hash matches `known_hash`.
+
+# In[ ]:
+
+
+def update_file(input_path, output_path, known_hash=None):
+    fingerprint = file_fingerprint(input_path)
+    if fingerprint['sha256'] == known_hash and os.path.exists(output_path):
+        return {'rows': 0, 'processed': False, 'fingerprint': fingerprint}
+    rows = process_file(input_path, output_path)
+    return {'rows': rows, 'processed': True, 'fingerprint': fingerprint}
+
+def check_manifest_entry(entry, input_path, output_path, code_version):
+    """Returns True if the output is up to date, otherwise the known hash of the input (or None)."""
+    if (entry is None or entry['code_version'] != code_version or entry['output'] != output_path 
+            or not os.path.exists(output_path) or not os.path.exists(input_path)):
+        return None
+    stat = os.stat(input_path)
+    if stat.st_size != entry['size']:
+        return None
+    if stat.st_mtime_ns == entry['mtime_ns']:
+        return True
+    return entry['sha256']
+
+
+# Finally, let's add the arguments `manifest_path` and `code_version` to `process_files`. When a `manifest_path` is given, the files that are up to date are skipped, and the manifest is updated with the fingerprints of the files that were processed successfully. The summary now also includes the number of files skipped.
+
+# In[ ]:
+
+
+def process_files(inputs, output_pattern, workers=None, max_in_flight=None, 
+                  manifest_path=None, code_version=PIPELINE_VERSION):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    manifest = load_manifest(manifest_path) if manifest_path is not None else None
+    
+    summary = {'files': 0, 'skipped': 0, 'rows': 0, 'errors': {}}
+    start_time = time.perf_counter()
+    
+    def collect(done):
+        for future in done:
+            input_path, output_path = in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                summary['files'] += 1
+                summary['errors'][input_path] = '{}: {}'.format(type(e).__name__, e)
+                if manifest is not None:
+                    manifest['files'].pop(input_path, None)
+                continue
+            if manifest is None:
+                summary['files'] += 1
+                summary['rows'] += result
+                continue
+            if result['processed']:
+                summary['files'] += 1
+                summary['rows'] += result['rows']
+            else:
+                summary['skipped'] += 1
+            manifest['files'][input_path] = dict(result['fingerprint'], output=output_path, 
+                                                 code_version=code_version)
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        for i, input_path in enumerate(inputs, start=1):
+            name = os.path.splitext(os.path.basename(input_path))[0]
+            output_path = output_pattern.format(i, name=name)
+            # Skip files that are up to date
+            known_hash = None
+            if manifest is not None:
+                entry = manifest['files'].get(input_path)
+                known_hash = check_manifest_entry(entry, input_path, output_path, code_version)
+                if known_hash is True:
+                    summary['skipped'] += 1
+                    continue
+            # Wait for a file to finish if too many are being processed
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            if manifest is None:
+                future = executor.submit(process_file, input_path, output_path)
+            else:
+                future = executor.submit(update_file, input_path, output_path, known_hash)
+            in_flight[future] = (input_path, output_path)
+        # Wait for the remaining files
+        collect(wait(in_flight).done)
+    
+    if manifest is not None:
+        save_manifest(manifest, manifest_path)
+    summary['seconds'] = time.perf_counter() - start_time
+    summary['rows_per_second'] = summary['rows'] / summary['seconds'] if summary['seconds'] else 0.0
+    return summary
+
+
+# To avoid modifying the original data files, let's work on copies of them in the directory `./data/batch`. The first time, all the files are processed.
+
+# In[ ]:
+
+
+import shutil
+
+os.makedirs('./data/batch', exist_ok=True)
+inputs = [shutil.copy('./data/loans{}.txt'.format(i), './data/batch') for i in range(1,4)]
+process_files(inputs, './data/batch/emis{}.txt', workers=2, manifest_path='./data/batch/manifest.json')
+
+
+# When we run it again, all the files are skipped.
+
+# In[ ]:
+
+
+process_files(inputs, './data/batch/emis{}.txt', workers=2, manifest_path='./data/batch/manifest.json')
+
+
+# If we modify one of the files, only that file is processed again.
+
+# In[ ]:
+
+
+with open('./data/batch/loans2.txt', 'a') as f:
+    f.write('50000,24,0.09,5000\n')
+
+
+# In[ ]:
+
+
+process_files(inputs, './data/batch/emis{}.txt', workers=2, manifest_path='./data/batch/manifest.json')
+
+
+# ### Caching parsed files in a binary format
+# 
+# Every time we read a file, every line has to be split and every value converted from text into a number. If the same file is read many times, we can save the parsed data in a *binary* file next to the original file (a *sidecar* file), from which it can be loaded much faster the next time.
+# 
+# We'll use a simple *columnar* layout, similar to `read_csv_columnar`:
+# 
+# * The file starts with a *magic number*: a few fixed bytes (`CSVCOL01`) that identify the format.
+# * Next comes a header (encoded as JSON, preceded by its length) that describes the columns, along with the size and modification time of the original CSV file and a *checksum* of the data.
+# * Finally, the data for each column follows. Columns containing only numbers are stored as raw 8-byte floating point numbers (exactly the bytes of an `array('d')`), and other columns are stored as JSON.
+# 
+# When the sidecar file is read, the size and modification time of the CSV file are compared with the ones in the header. If the CSV file has changed, the sidecar file is ignored (and later replaced). The checksum, computed using `zlib.crc32`, protects against sidecar files that have been damaged (e.g. by a crash while writing them).
+# 
+# Let's start by defining a function to create the sidecar file. The [`struct`](https://docs.python.org/3/library/struct.html) module is used to convert the length of the header into 8 bytes. Each block of data is padded with zero bytes to a multiple of 8 bytes, so that every numeric column starts at a position that's a multiple of 8. Like the manifest, the file is first written to a temporary file and then renamed. The caller passes in the result of `os.stat` for the CSV file, taken *before* the file was parsed: if the file is modified while it's being parsed, the sidecar file then records the old size and modification time, so it's ignored the next time instead of returning out of date data.
+
+# In[ ]:
+
+
+import struct
+import zlib
+
+SIDECAR_MAGIC = b'CSVCOL01'
+
+def sidecar_path(path):
+    return path + '.colcache'
+
+def write_sidecar(path, headers, columns, stat):
+    blocks, column_info = [], []
+    for header, column in zip(headers, columns):
+        if type(column) is array:
+            data, kind = column.tobytes(), 'd'
+        else:
+            data, kind = json.dumps(column).encode(), 'json'
+        column_info.append({'name': header, 'type': kind, 'size': len(data)})
+        blocks.append(data + b'\0' * (-len(data) % 8))
+    body = b''.join(blocks)
+    
+    header = {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns, 
+              'byteorder': sys.byteorder, 'crc32': zlib.crc32(body), 'columns': column_info}
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+    
+    temp_path = sidecar_path(path) + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(SIDECAR_MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        f.write(body)
+    os.replace(temp_path, sidecar_path(path))
+
+
+# To read the sidecar file, we memory-map it using `mmap` (as we did in `iter_csv_mmap`). The numeric columns are returned as `memoryview` objects, which give access to the numbers stored in the file without copying them (`cast('d')` interprets the bytes as 8-byte floating point numbers). They can be converted into NumPy arrays without copying using `np.frombuffer`. `read_sidecar` returns `None` if the sidecar file is missing, out of date or damaged.
+
+# In[ ]:
+
+
+def read_sidecar(path):
+    try:
+        stat = os.stat(path)
+        f = open(sidecar_path(path), 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < 16:
+            return None
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if m[:8] != SIDECAR_MAGIC:
+            return None
+        header_size, = struct.unpack_from('<Q', m, 8)
+        header = json.loads(m[16:16+header_size])
+        # Ignore the sidecar if the CSV file has changed
+        if (header['source_size'] != stat.st_size or header['source_mtime_ns'] != stat.st_mtime_ns 
+                or header['byteorder'] != sys.byteorder):
+            return None
+        data = memoryview(m)[16+header_size:]
+        if zlib.crc32(data) != header['crc32']:
+            return None
+        headers, columns, offset = [], [], 0
+        for info in header['columns']:
+            block = data[offset:offset+info['size']]
+            if info['type'] == 'd':
+                columns.append(block.cast('d'))
+            else:
+                columns.append(json.loads(bytes(block)))
+            headers.append(info['name'])
+            offset += info['size'] + (-info['size'] % 8)
+        return headers, columns
+    except (ValueError, KeyError, TypeError, struct.error):
+        return None
+
+
+# Next, `columns_from_rows` converts the rows returned by `read_csv` into columns. A sidecar file can only reproduce the rows exactly if every row has a value for every header, so the function returns `None` for files with missing values at the end of a line or duplicate headers.
+
+# In[ ]:
+
+
+def columns_from_rows(headers, rows):
+    if len(set(headers)) != len(headers) or any(len(row) != len(headers) for row in rows):
+        return None
+    columns = []
+    for header in headers:
+        values = [row[header] for row in rows]
+        if all(type(value) is float for value in values):
+            columns.append(array('d', values))
+        else:
+            columns.append(values)
+    return columns
+
+
+# Finally, let's add an argument `cache` to `read_csv`. We'll first move the code for parsing the file into a function `parse_csv` (it's the same code as in the previous version of `read_csv`). With `cache=True`, `read_csv` loads the rows from the sidecar file if it's up to date. Otherwise, it parses the CSV file and creates the sidecar file for next time (unless the CSV file changed while it was being parsed).
+
+# In[ ]:
+
+
+def parse_csv(path, workers=1, chunk_size=16*1024*1024, record=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        return list(iter_csv(path, record=record))
+    
+    # Parse the header
+    with open(path, 'r') as f:
+        header_line = f.readline()
+    if header_line == '':
+        return []
+    headers = parse_headers(header_line)
+    
+    # Small files aren't worth splitting
+    chunks = find_chunks(path, chunk_size)
+    if len(chunks) <= 1:
+        return list(iter_csv(path, record=record))
+    
+    # Parse the chunks in parallel & combine the results in order
+    result = []
+    starts, ends = zip(*chunks)
+    if record is not None:
+        create_item = record_factory(headers, record)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for rows in executor.map(parse_chunk, repeat(path), starts, ends, repeat(headers), repeat(record)):
+            if record is not None:
+                rows = map(create_item, rows)
+            result.extend(rows)
+    return result
+
+def read_csv(path, workers=1, chunk_size=16*1024*1024, record=None, cache=False):
+    if not cache:
+        return parse_csv(path, workers, chunk_size, record)
+    
+    # Load the columns from the sidecar file, or parse the file & create it
+    cached = read_sidecar(path)
+    if cached is not None:
+        headers, columns = cached
+    else:
+        stat = os.stat(path)
+        rows = parse_csv(path, workers, chunk_size)
+        # Take the headers from the rows, instead of reading the (possibly compressed) file again
+        headers = list(rows[0].keys()) if rows else []
+        columns = columns_from_rows(headers, rows) if rows else None
+        if columns is None:
+            return parse_csv(path, workers, chunk_size, record) if record is not None else rows
+        # Don't create the sidecar file if the CSV file changed while it was parsed
+        new_stat = os.stat(path)
+        if (new_stat.st_size, new_stat.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            write_sidecar(path, headers, columns, stat)
+    
+    # Create the rows from the columns
+    if record is None:
+        create_item = partial(create_item_dict, headers=headers)
+    else:
+        create_item = record_factory(headers, record)
+    return [create_item(values) for values in zip(*columns)]
+
+
+# Let's try it out. The first time, the sidecar file is created.
+
+# In[ ]:
+
+
+loans1 = read_csv('./data/loans1.txt', cache=True)
+os.listdir('./data')
+
+
+# The next time, the rows are loaded from the sidecar file.
+
+# In[ ]:
+
+
+read_csv('./data/loans1.txt', cache=True) == loans1
+
+
+# We can also use `read_sidecar` directly to access the columns without creating the rows. Here are the amounts of the loans, read from the sidecar file:
+
+# In[ ]:
+
+
+headers, columns = read_sidecar('./data/loans1.txt')
+headers, columns[0].tolist()
+
+
+# ### Downloading many files concurrently
+# 
+# At the start of this tutorial, we downloaded the files one after another using `urlretrieve`. Each download spends most of its time waiting for the network, so when there are hundreds of files to download, it's much faster to download several files at the same time. Since the work is waiting rather than computing, we can use threads (with a [`ThreadPoolExecutor`](https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor)) instead of processes.
+# 
+# A few more features are useful when downloading many files:
+# 
+# * **Connection reuse**: `urlretrieve` opens a new connection for every file. Using the [`http.client`](https://docs.python.org/3/library/http.client.html) module, each thread can keep its connection to a server open and use it for several files.
+# * **Retries with backoff**: If a download fails due to a network error or a server error (status code 5xx or 429), we wait for a short time and try again. The waiting time doubles after each failed attempt.
+# * **Resumable downloads**: The data is first written to a file ending with `.part`. If a download is interrupted, the next attempt asks the server to send only the remaining data using a `Range` header. The `ETag` (or else the `Last-Modified` date) of the file is saved next to the `.part` file and sent in an `If-Range` header, so the server only sends the remaining data if the file hasn't changed in the meantime. Otherwise (or if the server doesn't support ranges), it sends the whole file with status code 200, and the `.part` file is simply overwritten.
+# * **Atomic rename**: Once the download is complete, the `.part` file is renamed using `os.replace`, so a file with the final name is always complete.
+# 
+# Let's begin with a class that keeps the open connections. It's based on [`threading.local`](https://docs.python.org/3/library/threading.html#thread-local-data), so each thread gets its own dictionary of connections (a connection can't be used by two threads at the same time). All the connections are also added to the list `opened`, which is shared by the threads, so that they can be closed at the end.
+
+# In[ ]:
+
+
+import http.client
+import threading
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin, unquote
+from concurrent.futures import ThreadPoolExecutor
+
+class ConnectionPool(threading.local):
+    def __init__(self, opened, timeout=30):
+        self.connections = {}
+        self.opened = opened
+        self.timeout = timeout
+    
+    def get(self, scheme, netloc):
+        if (scheme, netloc) not in self.connections:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            elif scheme == 'http':
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            else:
+                raise ValueError('unsupported URL scheme: {}'.format(scheme))
+            self.connections[scheme, netloc] = conn
+            self.opened.append(conn)
+        return self.connections[scheme, netloc]
+    
+    def close_all(self):
+        for conn in self.opened:
+            conn.close()
+
+
+# Next, let's define a function to download a single file. It follows redirects (status codes 301, 302, 303, 307 & 308), which are commonly used by file hosting services. `http.client` doesn't raise an error if the connection is closed before all the data has been received, so we check `response.length` (the number of bytes remaining) at the end. When resuming a download, we also check that the `Content-Range` header of the response starts at the end of the `.part` file; if it doesn't, the `.part` file is deleted and the error is retried from the beginning.
+
+# In[ ]:
+
+
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+
+def validator_path(part_path):
+    return part_path + '.validator'
+
+def save_validator(part_path, response):
+    # If-Range requires a strong ETag (or else the modification date)
+    etag = response.getheader('ETag')
+    validator = etag if etag and not etag.startswith('W/') else response.getheader('Last-Modified')
+    if validator:
+        with open(validator_path(part_path), 'w') as f:
+            f.write(validator)
+    elif os.path.exists(validator_path(part_path)):
+        os.remove(validator_path(part_path))
+
+def load_validator(part_path):
+    try:
+        with open(validator_path(part_path)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def download_file(url, path, pool, block_size=64*1024, max_redirects=5):
+    part_path = path + '.part'
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # Only resume the download if the server can check that the file hasn't changed
+        validator = load_validator(part_path) if offset else None
+        if validator:
+            headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+        else:
+            headers = {}
+        
+        conn = pool.get(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', target, headers=headers)
+            response = conn.getresponse()
+            if response.status in REDIRECT_CODES:
+                response.read()
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if response.status == 416 and response.getheader('Content-Range') == 'bytes */{}'.format(offset):
+                # The partial file is already complete
+                response.read()
+            elif response.status in (200, 206):
+                if response.status == 206:
+                    content_range = response.getheader('Content-Range') or ''
+                    if not content_range.startswith('bytes {}-'.format(offset)):
+                        # Start again from scratch on the next attempt
+                        os.remove(part_path)
+                        raise http.client.HTTPException(
+                            'unexpected Content-Range {!r} (expected bytes {}-)'.format(content_range, offset))
+                else:
+                    save_validator(part_path, response)
+                with open(part_path, 'ab' if response.status == 206 else 'wb') as f:
+                    while True:
+                        block = response.read(block_size)
+                        if not block:
+                            break
+                        f.write(block)
+                if response.length:
+                    raise http.client.IncompleteRead(b'', response.length)
+            else:
+                response.read()
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+        os.replace(part_path, path)
+        if os.path.exists(validator_path(part_path)):
+            os.remove(validator_path(part_path))
+        return os.path.getsize(path)
+    raise HTTPError(url, response.status, 'too many redirects', response.headers, None)
+
+
+# The function `download_with_retries` retries failed downloads. Errors like 404 (Not Found) are not retried, since trying again won't help.
+
+# In[ ]:
+
+
+def is_retryable(error):
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+def download_with_retries(url, path, pool, retries=3, backoff=0.5):
+    for attempt in range(retries + 1):
+        try:
+            return download_file(url, path, pool)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+# Finally, `download_all` downloads a list of URLs into a directory using a pool of `concurrency` threads. The name of each file is taken from the last part of its URL. URLs without a file name (e.g. ending with `/`), or with the same file name as an earlier URL, are reported in `errors` instead of being downloaded (otherwise several threads would write the same `.part` file). Files that already exist in the directory are skipped, unless `overwrite=True`. Like `process_files`, it returns a summary, and failed downloads are reported in `errors` instead of stopping the other downloads.
+
+# In[ ]:
+
+
+def download_all(urls, dest_dir, concurrency=8, retries=3, backoff=0.5, timeout=30, overwrite=False):
+    start = time.perf_counter()
+    os.makedirs(dest_dir, exist_ok=True)
+    summary = {'files': 0, 'bytes': 0, 'skipped': 0, 'errors': {}}
+    
+    # Pick the destination of each URL
+    jobs, sources = {}, {}
+    for url in urls:
+        name = unquote(urlsplit(url).path.rsplit('/', 1)[-1])
+        path = os.path.join(dest_dir, name)
+        if name in ('', '.', '..') or os.sep in name or (os.altsep and os.altsep in name):
+            summary['errors'][url] = 'ValueError: no valid file name in the URL'
+        elif sources.setdefault(path, url) != url:
+            summary['errors'][url] = 'ValueError: same file name as {}'.format(sources[path])
+        elif not overwrite and os.path.exists(path):
+            summary['skipped'] += 1
+        else:
+            jobs[url] = path
+    
+    # Download the files in parallel
+    pool = ConnectionPool([], timeout)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {url: executor.submit(download_with_retries, url, path, pool, retries, backoff) 
+                       for url, path in jobs.items()}
+            for url, future in futures.items():
+                try:
+                    summary['bytes'] += future.result()
+                    summary['files'] += 1
+                except Exception as e:
+                    summary['errors'][url] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        pool.close_all()
+    
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+# Here's how we could download the three files from the start of the tutorial with a single function call:
+
+# In[ ]:
+
+
+download_all([url1, url2, url3], './data', overwrite=True)
+
+
+# To test `download_all` without depending on an external website, we can start a small web server on our own computer using the [`http.server`](https://docs.python.org/3/library/http.server.html) module. It runs in a background thread and serves the files in the `data` directory. We set `protocol_version` to `HTTP/1.1`, so that connections are kept open between requests. `SimpleHTTPRequestHandler` ignores the `Range` header and always sends the whole file, so to test resumable downloads, `RangeHandler` adds support for ranges like `bytes=100-`: it sends the rest of the file (status code 206, with a `Content-Range` header), or status code 416 if the range starts at the end of the file. Each file has an `ETag` based on its modification time and size, and the range is ignored (sending the whole file) if the `If-Range` header doesn't match it. The ranges requested and the status codes are recorded in `RangeHandler.requests`.
+
+# In[ ]:
+
+
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, format, *args):
+        pass
+
+def file_etag(path):
+    stat = os.stat(path)
+    return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+class RangeHandler(QuietHandler):
+    requests = []  # (Range header, status code) of each request for a file
+    
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().do_GET()
+        with open(path, 'rb') as f:
+            data = f.read()
+        etag = file_etag(path)
+        
+        # Only ranges like "bytes=100-" are supported, and If-Range must match the ETag
+        range_header = self.headers.get('Range', '')
+        start = None
+        if (range_header.startswith('bytes=') and range_header.endswith('-') and range_header[6:-1].isdigit() 
+                and self.headers.get('If-Range', etag) == etag):
+            start = int(range_header[6:-1])
+        
+        if start is not None and start >= len(data):
+            status, body = 416, b''
+            self.send_response(status)
+            self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+        elif start is not None:
+            status, body = 206, data[start:]
+            self.send_response(status)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            status, body = 200, data
+            self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        RangeHandler.requests.append((range_header or None, status))
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeHandler, directory='./data'))
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+base_url
+
+
+# Let's download the loan files from the local server into a new directory `downloads`. The URL `missing.txt` doesn't exist, so it shows up in `errors`.
+
+# In[ ]:
+
+
+local_urls = [base_url + name for name in ['loans1.txt', 'loans2.txt', 'loans3.txt', 'missing.txt']]
+download_all(local_urls, './downloads', concurrency=4)
+
+
+# In[ ]:
+
+
+os.listdir('./downloads')
+
+
+# If we run it again, the existing files are skipped.
+
+# In[ ]:
+
+
+download_all(local_urls, './downloads', concurrency=4)
+
+
+# URLs that would be saved under the same name, or that don't end with a file name, are reported as errors and not downloaded.
+
+# In[ ]:
+
+
+download_all([base_url + 'loans1.txt', base_url + 'loans1.txt?copy=2', base_url], './downloads2')
+
+
+# Now let's check that interrupted downloads are resumed. The function `make_part_file` simulates an interrupted download by saving the first `size` bytes of a file as a `.part` file, along with an ETag. When the ETag matches, the server sends only the rest of the file (206). When the file has changed since (simulated using an outdated ETag), the server sends the whole file (200), which replaces the `.part` file. If the `.part` file is already complete, the server responds with 416, and the `.part` file is simply renamed.
+
+# In[ ]:
+
+
+def make_part_file(name, dest_dir, size, etag):
+    os.makedirs(dest_dir, exist_ok=True)
+    part_path = os.path.join(dest_dir, name + '.part')
+    with open(os.path.join('./data', name), 'rb') as f:
+        data = f.read(size)
+    with open(part_path, 'wb') as f:
+        f.write(data)
+    with open(validator_path(part_path), 'w') as f:
+        f.write(etag)
+
+results = []
+for size, etag in [(100, file_etag('./data/loans3.txt')), (100, '"outdated"'), (10**6, file_etag('./data/loans3.txt'))]:
+    make_part_file('loans3.txt', './downloads3', size, etag)
+    download_all([base_url + 'loans3.txt'], './downloads3', overwrite=True)
+    with open('./downloads3/loans3.txt', 'rb') as f1, open('./data/loans3.txt', 'rb') as f2:
+        results.append((RangeHandler.requests[-1], f1.read() == f2.read()))
+results
+
+
+# Let's stop the server once we're done.
+
+# In[ ]:
+
+
+server.shutdown()
+server.server_close()
+
+
+# ### Processing files while they are being downloaded
+# 
+# So far, each file is downloaded completely and written into the `data` directory, and then read again and parsed by `read_csv`. Since `iter_csv` already processes the rows one by one, we can instead feed it the lines of the file *while they are being downloaded*, and compute the EMIs for the first rows long before the download is complete. This also avoids writing the file to disk and reading it back.
+# 
+# To do this, let's first separate the parsing logic of `iter_csv` from opening the file. The function `iter_csv_lines` accepts any iterable of lines (e.g. a file object, or a list of strings), and `iter_csv` simply opens the file and passes it to `iter_csv_lines`.
+
+# In[ ]:
+
+
+def iter_csv_lines(lines, sample_size=100, strict=False, record=None):
+    lines = iter(lines)
+    # Parse the header (an empty file has no rows)
+    header_line = next(lines, '')
+    if header_line == '':
+        return
+    headers = parse_headers(header_line)
+    # Choose how to parse the lines
+    if not strict:
+        sample = list(islice(lines, sample_size))
+        parse_line = make_line_parser(infer_converters(sample, len(headers)))
+        lines = chain(sample, lines)
+    else:
+        parse_line = parse_numeric_line
+    # Choose how to create the rows
+    if record is None:
+        create_item = partial(create_item_dict, headers=headers)
+    else:
+        create_item = record_factory(headers, record)
+    # Parse the lines one by one
+    for data_line in lines:
+        # Rows with quoted values can span multiple lines
+        if '"' in data_line and data_line.count('"') % 2 == 1:
+            data_line = read_record(data_line, lines)
+        yield create_item(parse_line(data_line))
+
+def iter_csv(path, sample_size=100, strict=False, record=None):
+    # Open the file in read mode
+    with open(path, 'r') as f:
+        yield from iter_csv_lines(f, sample_size, strict, record)
+
+
+# The response returned by `urlopen` is a binary file object, which we can wrap in an [`io.TextIOWrapper`](https://docs.python.org/3/library/io.html#io.TextIOWrapper) to read it line by line, just like a file opened with `open`. The text wrapper uses the `read1` method of the response, which returns the data that has arrived so far instead of waiting for a full block.
+# 
+# To optionally save a copy of the file while it's being processed (a *tee*, named after the T-shaped pipe fitting), we'll define a small class `TeeReader`, which writes all the data read from the response into a file. As with `download_file`, the copy is written to a `.part` file and renamed only after the download is complete. If the download fails, or the rows aren't fully consumed, the `.part` file is deleted.
+
+# In[ ]:
+
+
+from urllib.request import urlopen
+
+class TeeReader(io.RawIOBase):
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        data = self.source.read1(len(buffer))
+        self.sink.write(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+def stream_url(url, tee_path=None, timeout=30):
+    with urlopen(url, timeout=timeout) as response:
+        if tee_path is None:
+            yield from io.TextIOWrapper(response, encoding='utf-8')
+        else:
+            part_path = tee_path + '.part'
+            try:
+                with open(part_path, 'wb') as f:
+                    yield from io.TextIOWrapper(io.BufferedReader(TeeReader(response, f)), encoding='utf-8')
+                    # The server closed the connection early
+                    if response.length:
+                        raise http.client.IncompleteRead(b'', response.length)
+            except BaseException:
+                os.remove(part_path)
+                raise
+            os.replace(part_path, tee_path)
+        if response.length:
+            raise http.client.IncompleteRead(b'', response.length)
+
+
+# Putting it all together, `stream_emis` downloads a file, parses the rows and computes the EMIs, all at the same time. It returns a generator, which can be passed directly to `write_csv`.
+
+# In[ ]:
+
+
+def stream_emis(url, tee_path=None, timeout=30, record=None):
+    return iter_emis(iter_csv_lines(stream_url(url, tee_path, timeout), record=record))
+
+
+# Here's how we can compute the EMIs for the first file from the start of the tutorial without downloading it first, while also saving a copy in the `data` directory:
+
+# In[ ]:
+
+
+write_csv(stream_emis(url1, tee_path='./data/loans1.txt'), './data/emis1.txt')
+
+
+# Let's try it out using a local web server, as before.
+
+# In[ ]:
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory='./data'))
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+
+# The first loan is available as soon as the first few lines have arrived.
+
+# In[ ]:
+
+
+next(stream_emis(base_url + 'loans2.txt'))
+
+
+# Let's process the entire file while saving a copy in the `downloads` directory, and verify the results.
+
+# In[ ]:
+
+
+write_csv(stream_emis(base_url + 'loans2.txt', tee_path='./downloads/loans2_copy.txt'), './downloads/emis2.txt')
+
+
+# In[ ]:
+
+
+read_csv('./downloads/emis2.txt') == list(iter_emis(read_csv('./data/loans2.txt')))
+
+
+# In[ ]:
+
+
+read_csv('./downloads/loans2_copy.txt') == read_csv('./data/loans2.txt')
+
+
+# In[ ]:
+
+
+server.shutdown()
+server.server_close()
+
+
+# ### Keeping an index of the data directory
+# 
+# To find the input files, we've been calling `os.listdir` and `os.path.exists` again and again. When the data directory contains thousands of files in many subdirectories, every such call has to ask the operating system to read the whole directory again. Instead, we can keep an *index*: a small database listing the path, size, modification time and inode number of every file, which is built once and then updated incrementally.
+# 
+# We'll store the index using the [`sqlite3`](https://docs.python.org/3/library/sqlite3.html) module, which is included with Python. SQLite stores an entire database in a single file, and supports *indexes* on columns: the index on `mtime_ns` lets us find the files modified after a certain time without looking at the other files, and the index on `parent` lets us find the contents of a directory.
+
+# In[ ]:
+
+
+import sqlite3
+
+def open_index(index_path):
+    conn = sqlite3.connect(index_path)
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, parent TEXT, is_dir INTEGER, '
+                     'size INTEGER, mtime_ns INTEGER, inode INTEGER)')
+        conn.execute('CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime_ns)')
+        conn.execute('CREATE INDEX IF NOT EXISTS files_parent ON files (parent)')
+    return conn
+
+
+# To update the index, `refresh_index` goes through the directories one by one using `os.scandir`, and compares each file with the information in the index. Only new, modified and deleted files lead to changes in the database.
+# 
+# By default, every file is checked using `os.stat`, so files that are modified *in place* (e.g. overwritten using `open(path, 'w')`, or appended to) are always noticed. When the directories contain many files, most of this work can be skipped: the modification time of a *directory* changes whenever a file is created, deleted or renamed inside it, which is how new input files usually arrive (e.g. `download_all` renames each `.part` file once it's complete). With `full=False`, a directory whose modification time hasn't changed isn't scanned again, and only its subdirectories are checked. This is much faster, but it's a trade-off: files modified in place don't change the modification time of their directory, so they're missed (and `changed_since` won't return them) until the next full refresh. Only use `full=False` when files are always created by renaming them, or when the paths of the modified files are passed to `update_index_paths` (defined below).
+# 
+# The modification time of a directory is only saved in the index once the directory itself has been scanned. A deleted directory is removed from the index along with everything inside it. Files that are deleted while a directory is being scanned are simply treated as deleted, and directories that can't be read (e.g. due to missing permissions) are left unchanged in the index, so that a single unreadable directory doesn't stop the whole refresh.
+
+# In[ ]:
+
+
+def remove_from_index(conn, path):
+    # Delete the path along with everything inside it
+    prefix = path + os.sep
+    end = path + chr(ord(os.sep) + 1)
+    return conn.execute('DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)', 
+                        (path, prefix, end)).rowcount
+
+def refresh_index(conn, top, full=True):
+    top = os.path.normpath(top)
+    counts = {'added': 0, 'updated': 0, 'removed': 0}
+    stack = [top]
+    with conn:
+        while stack:
+            dir_path = stack.pop()
+            try:
+                dir_stat = os.stat(dir_path)
+            except FileNotFoundError:
+                counts['removed'] += remove_from_index(conn, dir_path)
+                continue
+            except OSError:
+                # Leave the index unchanged for directories that can't be read
+                continue
+            row = conn.execute('SELECT mtime_ns FROM files WHERE path = ?', (dir_path,)).fetchone()
+            known = {path: (is_dir, size, mtime_ns, inode) for path, is_dir, size, mtime_ns, inode in conn.execute(
+                'SELECT path, is_dir, size, mtime_ns, inode FROM files WHERE parent = ?', (dir_path,))}
+            
+            # Skip directories which haven't changed since the last scan
+            if not full and row is not None and row[0] == dir_stat.st_mtime_ns:
+                stack.extend(path for path, values in known.items() if values[0])
+                continue
+            
+            seen = set()
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            if not is_dir:
+                                stat = entry.stat(follow_symlinks=False)
+                                values = (0, stat.st_size, stat.st_mtime_ns, entry.inode())
+                        except OSError:
+                            # Skip entries that were deleted while scanning (they're removed below)
+                            continue
+                        seen.add(entry.path)
+                        old = known.get(entry.path)
+                        if is_dir:
+                            # A directory's own details are saved when it is scanned
+                            if old is None:
+                                conn.execute('INSERT INTO files VALUES (?, ?, 1, NULL, NULL, NULL)', (entry.path, dir_path))
+                            stack.append(entry.path)
+                            continue
+                        if old != values:
+                            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', (entry.path, dir_path) + values)
+                            counts['added' if old is None else 'updated'] += 1
+            except (FileNotFoundError, NotADirectoryError):
+                # The directory was deleted (or replaced by a file) since it was found
+                counts['removed'] += remove_from_index(conn, dir_path)
+                continue
+            except OSError:
+                # Leave the index unchanged for directories that can't be read
+                continue
+            for path in known.keys() - seen:
+                counts['removed'] += remove_from_index(conn, path)
+            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, 1, ?, ?, ?)', 
+                         (dir_path, os.path.dirname(dir_path), dir_stat.st_size, dir_stat.st_mtime_ns, dir_stat.st_ino))
+    return counts
+
+
+# When we already know which files have changed (e.g. because we just wrote them, or because the operating system notified us), there's no need to scan any directories: `update_index_paths` simply checks the given paths.
+
+# In[ ]:
+
+
+def update_index_paths(conn, paths):
+    with conn:
+        for path in paths:
+            path = os.path.normpath(path)
+            try:
+                stat = os.stat(path, follow_symlinks=False)
+            except FileNotFoundError:
+                remove_from_index(conn, path)
+                continue
+            if not os.path.isdir(path):
+                conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, 0, ?, ?, ?)', 
+                             (path, os.path.dirname(path), stat.st_size, stat.st_mtime_ns, stat.st_ino))
+
+
+# Finally, let's define two functions for looking up files in the index. `find_files` returns the files matching a glob pattern like `loans*.txt`, and `changed_since` returns only the files modified after a certain time (in seconds, as returned by `time.time()`). The pattern is matched against the file name using the `fnmatch` module. The operating system sets modification times using a clock that's only updated every few milliseconds, so a file modified just after `time.time()` was called can have a slightly *earlier* modification time. To avoid missing such files, `changed_since` also returns the files modified up to `margin` seconds (0.1 by default) before the timestamp.
+
+# In[ ]:
+
+
+import fnmatch
+
+def match_names(rows, pattern):
+    if pattern is None:
+        return [path for path, in rows]
+    return [path for path, in rows if fnmatch.fnmatch(os.path.basename(path), pattern)]
+
+def find_files(conn, top, pattern=None):
+    top = os.path.normpath(top)
+    rows = conn.execute('SELECT path FROM files WHERE is_dir = 0 AND path >= ? AND path < ? ORDER BY path', 
+                        (top + os.sep, top + chr(ord(os.sep) + 1)))
+    return match_names(rows, pattern)
+
+def changed_since(conn, timestamp, pattern=None, margin=0.1):
+    rows = conn.execute('SELECT path FROM files WHERE mtime_ns > ? AND is_dir = 0 ORDER BY mtime_ns', 
+                        (int((timestamp - margin) * 1e9),))
+    return match_names(rows, pattern)
+
+
+# Let's build an index of a new directory `indexed`, containing copies of the loan files (so that the examples below don't modify the `data` directory). The index is stored outside the directory, so that updating the index doesn't modify the directory. Any index left over from a previous run is deleted first.
+
+# In[ ]:
+
+
+import shutil
+
+shutil.rmtree('./indexed', ignore_errors=True)
+os.makedirs('./indexed')
+for i in range(1, 4):
+    shutil.copy('./data/loans{}.txt'.format(i), './indexed')
+if os.path.exists('./indexed.sqlite'):
+    os.remove('./indexed.sqlite')
+
+file_index = open_index('./indexed.sqlite')
+refresh_index(file_index, './indexed')
+
+
+# In[ ]:
+
+
+find_files(file_index, './indexed', 'loans*.txt')
+
+
+# Refreshing the index again doesn't find any changes, whether every file is checked (the default) or only the modification time of the directory (`full=False`).
+
+# In[ ]:
+
+
+refresh_index(file_index, './indexed'), refresh_index(file_index, './indexed', full=False)
+
+
+# Now let's add a new loan file, append a loan to an existing file, and look for the loan files which have changed since then.
+
+# In[ ]:
+
+
+checkpoint = time.time()
+write_csv(read_csv('./indexed/loans3.txt'), './indexed/loans4.txt')
+with open('./indexed/loans1.txt', 'a') as f:
+    f.write('50000,24,0.09,5000\n')
+refresh_index(file_index, './indexed')
+
+
+# In[ ]:
+
+
+changed_since(file_index, checkpoint, 'loans*.txt')
+
+
+# With `full=False`, a file that's modified in place is missed, since the modification time of its directory doesn't change. The next full refresh finds it.
+
+# In[ ]:
+
+
+with open('./indexed/loans2.txt', 'a') as f:
+    f.write('50000,24,0.09,5000\n')
+refresh_index(file_index, './indexed', full=False), refresh_index(file_index, './indexed')
+
+
+# In[ ]:
+
+
+file_index.close()
+
+
+# ### Processing new files as soon as they arrive
+# 
+# Instead of processing all the files again every once in a while, we can write a program that keeps running and *watches* a directory, processing each new or modified loan file as soon as it arrives.
+# 
+# On Linux, the operating system can notify us about changes to a directory using [inotify](https://man7.org/linux/man-pages/man7/inotify.7.html). Python doesn't include a module for inotify, but we can call the functions of the C standard library directly using the [`ctypes`](https://docs.python.org/3/library/ctypes.html) module. We ask to be notified when a file opened for writing is closed (`IN_CLOSE_WRITE`), or when a file is moved into the directory (`IN_MOVED_TO`), which is how `download_all` and `os.replace` create complete files. On other operating systems, or if inotify isn't available, `open_inotify` returns `None`, and we'll fall back to *polling*, i.e. scanning the directory at regular intervals.
+
+# In[ ]:
+
+
+import ctypes
+import ctypes.util
+import select
+import statistics
+
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_Q_OVERFLOW = 0x8, 0x80, 0x4000
+
+def open_inotify(directory):
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+# The notifications are read from the file descriptor returned by `inotify_init1`. We use `select.select` to wait until a notification arrives, or until `timeout` seconds have passed. Each notification consists of a 16-byte header (which we decode using `struct`) followed by the name of the file. If too many notifications arrive at once, the operating system drops some of them and reports `IN_Q_OVERFLOW`; in that case we treat every file in the directory as changed.
+
+# In[ ]:
+
+
+def read_inotify(fd, directory, timeout):
+    if not select.select([fd], [], [], timeout)[0]:
+        return []
+    data = os.read(fd, 64*1024)
+    names, offset = [], 0
+    while offset < len(data):
+        _, mask, _, length = struct.unpack_from('iIII', data, offset)
+        name = data[offset+16:offset+16+length].rstrip(b'\0')
+        offset += 16 + length
+        if mask & IN_Q_OVERFLOW:
+            names.extend(os.listdir(directory))
+        elif name:
+            names.append(os.fsdecode(name))
+    return names
+
+def poll_directory(directory, snapshot):
+    current = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                current[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    changed = [name for name, values in current.items() if snapshot.get(name) != values]
+    snapshot.clear()
+    snapshot.update(current)
+    return changed
+
+
+# Now we can define `watch_directory`, which processes each new or modified file whose name matches `pattern` using `process_file`. Here's how it works:
+# 
+# * A file often triggers several notifications in a short time (e.g. if it's written in several steps). To avoid processing it several times, a file is only processed once it hasn't changed for `debounce` seconds (this is called *debouncing*). When polling, a file must stay unchanged for at least one full `poll_interval`, so that files which are still being written aren't processed.
+# * Like `process_files`, the files are processed using a pool of worker processes. At most `workers` files are processed at the same time; the others wait in `pending`. A file that's modified while it's being processed is processed again afterwards.
+# * The watcher stops when the `stop` event (a [`threading.Event`](https://docs.python.org/3/library/threading.html#threading.Event)) is set, or after processing `max_files` files. It then returns a summary, including the *latency* of each file: the time from its first notification until its EMIs were written.
+# 
+# Like in `process_files`, the path of each output file is created using `output_pattern.format(...)`: `{name}` is the name of the input file without the extension, and `{}` is a counter of the files processed so far (starting from 1). Since the same file can be processed several times, `{name}` is usually the better choice. The output files should be written into a different directory, or use names that don't match `pattern`, otherwise the output files would be processed too.
+
+# In[ ]:
+
+
+def watch_directory(directory, output_pattern, pattern='loans*.txt', workers=2, debounce=0.2, 
+                    poll_interval=0.25, use_inotify=True, stop=None, max_files=None):
+    fd = open_inotify(directory) if use_inotify else None
+    snapshot = {}
+    if fd is None:
+        # The files which already exist are not new
+        poll_directory(directory, snapshot)
+        debounce = max(debounce, poll_interval)
+    last_poll = time.monotonic()
+    
+    summary = {'files': 0, 'rows': 0, 'errors': {}, 'latencies': []}
+    submitted = 0
+    pending = {}    # path -> (time of first event, time of last event)
+    in_flight = {}  # future -> (path, time of first event)
+    
+    def collect(done):
+        for future in done:
+            input_path, first_event = in_flight.pop(future)
+            summary['files'] += 1
+            try:
+                summary['rows'] += future.result()
+            except Exception as e:
+                summary['errors'][input_path] = '{}: {}'.format(type(e).__name__, e)
+            summary['latencies'].append(time.monotonic() - first_event)
+    
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while not (stop is not None and stop.is_set()) and (max_files is None or summary['files'] < max_files):
+                # Wait for notifications until the next file is due
+                now = time.monotonic()
+                timeout = min([last + debounce - now for _, last in pending.values()] + [poll_interval])
+                if in_flight:
+                    timeout = min(timeout, 0.01)
+                if fd is not None:
+                    names = read_inotify(fd, directory, max(timeout, 0))
+                else:
+                    time.sleep(max(timeout, 0))
+                    names = []
+                    if time.monotonic() - last_poll >= poll_interval:
+                        names = poll_directory(directory, snapshot)
+                        last_poll = time.monotonic()
+                
+                now = time.monotonic()
+                for name in names:
+                    if fnmatch.fnmatch(name, pattern):
+                        path = os.path.join(directory, name)
+                        first_event = pending[path][0] if path in pending else now
+                        pending[path] = (first_event, now)
+                
+                collect([future for future in in_flight if future.done()])
+                
+                # Start processing the files which haven't changed recently
+                busy = {path for path, _ in in_flight.values()}
+                for path, (first_event, last_event) in list(pending.items()):
+                    if len(in_flight) >= workers:
+                        break
+                    if path not in busy and now - last_event >= debounce:
+                        del pending[path]
+                        submitted += 1
+                        name = os.path.splitext(os.path.basename(path))[0]
+                        output_path = output_pattern.format(submitted, name=name)
+                        future = executor.submit(process_file, path, output_path)
+                        in_flight[future] = (path, first_event)
+            # Wait for the remaining files
+            collect(wait(in_flight).done)
+    finally:
+        if fd is not None:
+            os.close(fd)
+    
+    summary['median_latency'] = statistics.median(summary['latencies']) if summary['latencies'] else None
+    return summary
+
+
+# Let's try it out. We'll create two directories: `incoming` for the loan files, and `incoming_emis` for the results. To simulate new files arriving, a background thread copies the three loan files into `incoming`, one every 0.3 seconds, while `watch_directory` waits for them. The timer sets the `stop` event after 10 seconds, in case something goes wrong.
+
+# In[ ]:
+
+
+os.makedirs('./incoming', exist_ok=True)
+os.makedirs('./incoming_emis', exist_ok=True)
+
+def deliver_files():
+    for i in range(1, 4):
+        time.sleep(0.3)
+        write_csv(read_csv('./data/loans{}.txt'.format(i)), './incoming/loans{}.txt'.format(i))
+
+stop = threading.Event()
+threading.Timer(10, stop.set).start()
+threading.Thread(target=deliver_files).start()
+watch_summary = watch_directory('./incoming', './incoming_emis/{name}.emis.txt', stop=stop, max_files=3)
+stop.set()
+watch_summary
+
+
+# In[ ]:
+
+
+os.listdir('./incoming_emis')
+
+
+# ### Writing files safely
+# 
+# `write_csv` opens the output file in write mode, which immediately erases its contents. If the program crashes (or the computer loses power) halfway through, we're left with a half-written file, which looks just like a complete one. To avoid this, we can write the data into a temporary file in the same directory, and rename it once it's complete using `os.replace`. Renaming a file is *atomic*: other programs see either the old file or the new one, never a partially written file.
+# 
+# Even after a file is closed, its data may stay in the operating system's memory for a while before it's actually written to the disk. The function [`os.fsync`](https://docs.python.org/3/library/os.html#os.fsync) waits until the data of a file is on the disk. To make sure that a renamed file survives a power loss, the directory containing it must also be flushed using `os.fsync` (this isn't supported on Windows, where renames are handled by the file system itself).
+
+# In[ ]:
+
+
+import itertools
+
+temp_path_counter = itertools.count()
+
+def temp_output_path(path):
+    # A unique name, so that several threads or processes (or several writes
+    # from the same thread) can write the same file
+    return '{}.{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident(), next(temp_path_counter))
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_directory(directory):
+    if os.name != 'posix':
+        return
+    fd = os.open(directory or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Calling `os.fsync` is slow, since it has to wait for the disk. When we write many output files, it's much faster to write all of them first, and then flush them together: the disk can then handle many files at once, instead of stopping after each one. This is known as *group commit*.
+# 
+# The class `GroupCommit` collects the temporary files written by `write_csv`. Its method `commit` flushes all of them in parallel (using a pool of threads, since `os.fsync` releases the GIL while waiting), then renames them, and finally flushes each directory once. Until then, the output files aren't replaced. Note that the group as a whole is *not* atomic: each rename is, but if the program crashes while the files are being renamed, some of the output files are replaced and others aren't. If an error occurs while committing, the temporary files that haven't been renamed yet are removed. If the same output file is written several times before the group is committed, only the last version is kept. It can be used in a `with` block, which commits the files at the end of the block, or discards them if an error occurs. With `max_files`, the files are committed automatically whenever that many files are waiting.
+
+# In[ ]:
+
+
+class GroupCommit:
+    def __init__(self, max_files=None, workers=8):
+        self.max_files = max_files
+        self.workers = workers
+        self.files = {}  # path -> temporary path
+    
+    def add(self, path, temp_path=None):
+        # If the same file is written twice, the last version wins
+        path = os.path.abspath(path)
+        old_temp_path = self.files.pop(path, None)
+        if old_temp_path is not None and old_temp_path != temp_path and os.path.exists(old_temp_path):
+            os.remove(old_temp_path)
+        self.files[path] = temp_path
+        if self.max_files is not None and len(self.files) >= self.max_files:
+            self.commit()
+    
+    def commit(self):
+        files, self.files = self.files, {}
+        num_files = len(files)
+        directories = {os.path.dirname(path) for path in files}
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(fsync_path, [temp_path or path for path, temp_path in files.items()]))
+            for path, temp_path in list(files.items()):
+                if temp_path is not None:
+                    os.replace(temp_path, path)
+                del files[path]
+        except BaseException:
+            # Remove the temporary files which haven't been renamed
+            self.files = files
+            self.discard()
+            raise
+        for directory in directories:
+            fsync_directory(directory)
+        return num_files
+    
+    def discard(self):
+        files, self.files = self.files, {}
+        for temp_path in files.values():
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+# Now let's update `write_csv`. The code for writing the rows moves into a function `write_rows`, which is the same as the previous version of `write_csv`. `write_csv` takes two new arguments:
+# 
+# * `atomic` (`True` by default): write into a temporary file and rename it. When appending to a file (`mode='a'`), the rows are written directly to the file, since renaming would require copying the existing contents.
+# * `sync`: `False` (the default) doesn't call `os.fsync`, `True` flushes the file and its directory before returning, and a `GroupCommit` object adds the file to the group, which replaces the destination when it's committed.
+
+# In[ ]:
+
+
+def write_rows(f, items, formats=None, batch_size=1000):
+    count = 0
+    # Return if there's nothing to write
+    items = iter(items)
+    first_item = next(items, None)
+    if first_item is None:
+        return count
+    
+    # Write the headers in the first line (unless we're appending to a file)
+    is_dict = isinstance(first_item, dict)
+    if is_dict:
+        headers = list(first_item.keys())
+    else:
+        headers = list(record_fields(type(first_item)))
+    if f.tell() == 0:
+        f.write(','.join(map(quote_value, headers)) + '\n')
+    
+    # Write the items in batches
+    format_row = make_row_formatter(headers, is_dict, formats)
+    batch = [format_row(first_item)]
+    for item in items:
+        batch.append(format_row(item))
+        if len(batch) >= batch_size:
+            f.write('\n'.join(batch) + '\n')
+            count += len(batch)
+            batch = []
+    if batch:
+        f.write('\n'.join(batch) + '\n')
+        count += len(batch)
+    return count
+
+def write_csv(items, path, mode='w', formats=None, batch_size=1000, buffer_size=1024*1024, atomic=True, sync=False):
+    atomic = atomic and mode == 'w'
+    target = temp_output_path(path) if atomic else path
+    try:
+        # Open the file in write (or append) mode
+        with open(target, mode, buffering=buffer_size) as f:
+            count = write_rows(f, items, formats, batch_size)
+            if sync is True:
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        if atomic and os.path.exists(target):
+            os.remove(target)
+        raise
+    
+    # Replace the destination with the complete file
+    if isinstance(sync, GroupCommit):
+        sync.add(path, target if atomic else None)
+    elif atomic:
+        os.replace(target, path)
+        if sync is True:
+            fsync_directory(os.path.dirname(path))
+    return count
+
+
+# Since `process_file` uses `write_csv`, the files created by `process_files` and `watch_directory` are now also written atomically. Let's verify that the output is the same as before.
+
+# In[ ]:
+
+
+write_csv(loans1, './data/emis1.txt')
+read_csv('./data/emis1.txt') == loans1
+
+
+# If an error occurs while writing, the existing file isn't modified, and no temporary file is left behind.
+
+# In[ ]:
+
+
+def broken_loans():
+    yield from loans1
+    raise ValueError('the input is broken')
+
+try:
+    write_csv(broken_loans(), './data/emis1.txt')
+except ValueError as e:
+    print(e)
+read_csv('./data/emis1.txt') == loans1, [name for name in os.listdir('./data') if name.endswith('.tmp')]
+
+
+# Finally, let's compare the time taken to write 100 files, without `fsync`, with `fsync` for every file, and with a group commit. The difference depends a lot on the disk: on a hard drive or a network drive, every `os.fsync` can take several milliseconds or more.
+
+# In[ ]:
+
+
+os.makedirs('./synced', exist_ok=True)
+
+def write_synced_files(sync):
+    for i in range(100):
+        write_csv(loans1, './synced/emis{}.txt'.format(i), sync=sync)
+
+start = time.perf_counter()
+write_synced_files(False)
+print('No fsync: {:.3f}s'.format(time.perf_counter() - start))
+
+start = time.perf_counter()
+write_synced_files(True)
+print('fsync for every file: {:.3f}s'.format(time.perf_counter() - start))
+
+start = time.perf_counter()
+with GroupCommit() as group:
+    write_synced_files(group)
+print('Group commit: {:.3f}s'.format(time.perf_counter() - start))
+
+
+# ### Benchmarking the pipeline
+# 
+# We've made many changes to speed up reading, computing and writing the loans, and measured a few of them along the way. To check that future changes don't make things slower (a *regression*), it helps to have a *benchmark*: a repeatable measurement of each stage of the pipeline, whose results can be saved and compared.
+# 
+# First, let's write a function to generate a synthetic loan file. Using `random.Random` with a fixed `seed` makes sure that the same file is generated every time. The file can have extra numeric columns, a fraction of empty values (`empty_ratio`) and a text column `description` in which a fraction of the values (`quoted_ratio`) contain commas and double quotes, and therefore need to be quoted.
+
+# In[ ]:
+
+
+import platform
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def generate_loan_file(path, rows=100000, extra_columns=0, empty_ratio=0.1, quoted_ratio=0.0, seed=42):
+    rng = random.Random(seed)
+    headers = ['amount', 'duration', 'rate', 'down_payment'] + ['extra{}'.format(i) for i in range(1, extra_columns+1)]
+    if quoted_ratio:
+        headers.append('description')
+    
+    def maybe_empty(text):
+        return '' if rng.random() < empty_ratio else text
+    
+    with open(path, 'w') as f:
+        f.write(','.join(headers) + '\n')
+        for _ in range(rows):
+            amount = rng.randrange(10000, 5000000, 100)
+            values = [str(amount), str(rng.randrange(6, 361, 6)), str(rng.randrange(0, 21) / 100), 
+                      maybe_empty(str(rng.randrange(0, amount // 2, 100)))]
+            values += [maybe_empty('{:.2f}'.format(rng.random() * 1000)) for _ in range(extra_columns)]
+            if quoted_ratio:
+                values.append(quote_value('Loan for a "new" car, {} months'.format(values[1])) 
+                              if rng.random() < quoted_ratio else 'Loan')
+            f.write(','.join(values) + '\n')
+
+
+# Next, we need a way to measure the time and memory used by each stage:
+# 
+# * `time_stage` runs a function `repeat` times and returns the shortest time, since the longer times are usually caused by other programs running on the computer. The optional `setup` function runs before each repetition, without being timed.
+# * `peak_rss_mb` returns the peak *resident set size* (RSS) of the process, i.e. the largest amount of memory it has used so far, using the [`resource`](https://docs.python.org/3/library/resource.html) module. Since it's the peak for the whole process, the value reported for a stage includes the earlier stages. The `resource` module isn't available on Windows, where it returns `None`.
+# * `clear_emi_caches` empties the caches used by `compute_emis`, so that every repetition starts from an empty cache.
+
+# In[ ]:
+
+
+def time_stage(run, setup=None, repeat=3):
+    best, result = None, None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def clear_emi_caches():
+    cached_loan_emi.cache_clear()
+    cached_loan_emi.growth_factor.cache_clear()
+
+
+# `run_benchmarks` generates a file, and then times each stage: `read_csv`, `parse_values` (on lines already in memory, without any I/O), `loan_emi` (on the terms of each loan), `compute_emis` and `write_csv`. For each stage, it reports the time taken, the number of rows processed per second, the number of megabytes read or written per second (for the stages that read or write files), and the peak RSS. The results are returned as a dictionary, along with the parameters and details about the Python installation, and can be saved as a JSON file.
+
+# In[ ]:
+
+
+def run_benchmarks(rows=100000, extra_columns=0, empty_ratio=0.1, quoted_ratio=0.0, seed=42, repeat=3, 
+                   work_dir='./benchmarks', output_path=None):
+    params = {'rows': rows, 'extra_columns': extra_columns, 'empty_ratio': empty_ratio, 
+              'quoted_ratio': quoted_ratio, 'seed': seed, 'repeat': repeat}
+    os.makedirs(work_dir, exist_ok=True)
+    input_path = os.path.join(work_dir, 'loans.txt')
+    output_file = os.path.join(work_dir, 'emis.txt')
+    generate_loan_file(input_path, rows, extra_columns, empty_ratio, quoted_ratio, seed)
+    with open(input_path, 'r') as f:
+        f.readline()
+        lines = f.readlines()
+    
+    stages = {}
+    def record(name, seconds, num_bytes=None):
+        stages[name] = {'seconds': seconds, 
+                        'rows_per_second': rows / seconds, 
+                        'mb_per_second': num_bytes / seconds / 1e6 if num_bytes is not None else None, 
+                        'peak_rss_mb': peak_rss_mb()}
+    
+    seconds, loans = time_stage(lambda: read_csv(input_path), repeat=repeat)
+    record('read_csv', seconds, os.path.getsize(input_path))
+    seconds, _ = time_stage(lambda: [parse_values(line) for line in lines], repeat=repeat)
+    record('parse_values', seconds, sum(map(len, lines)))
+    terms = [(loan['amount'], loan['duration'], loan['rate']/12, loan['down_payment']) for loan in loans]
+    seconds, _ = time_stage(lambda: [loan_emi(*loan_terms) for loan_terms in terms], repeat=repeat)
+    record('loan_emi', seconds)
+    seconds, _ = time_stage(lambda: compute_emis(loans), setup=clear_emi_caches, repeat=repeat)
+    record('compute_emis', seconds)
+    seconds, _ = time_stage(lambda: write_csv(loans, output_file), repeat=repeat)
+    record('write_csv', seconds, os.path.getsize(output_file))
+    
+    results = {'params': params, 'python': platform.python_version(), 'platform': platform.platform(), 
+               'numpy': np is not None, 'stages': stages}
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+# Finally, `compare_benchmarks` compares the results with a *baseline*: results saved earlier, e.g. before making a change. A stage is flagged as a regression if it processes fewer rows per second than the baseline by more than `tolerance` (20% by default; timings on a busy computer can easily vary by 10% or more). The benchmarks must be run with the same parameters, otherwise the results can't be compared.
+
+# In[ ]:
+
+
+def compare_benchmarks(results, baseline, tolerance=0.2):
+    if results['params'] != baseline['params']:
+        raise ValueError('the benchmarks were run with different parameters')
+    comparison = {}
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        before = baseline['stages'][name]['rows_per_second']
+        change = stage['rows_per_second'] / before - 1
+        comparison[name] = {'baseline_rows_per_second': before, 'rows_per_second': stage['rows_per_second'], 
+                            'change': change, 'regression': change < -tolerance}
+    return comparison
+
+
+# Let's run the benchmarks on a file with 20,000 rows, some of them containing quoted values, and save the results as a baseline.
+
+# In[ ]:
+
+
+baseline = run_benchmarks(rows=20000, quoted_ratio=0.1, output_path='./benchmarks/baseline.json')
+baseline['stages']
+
+
+# After making a change, we can run the benchmarks again, and compare the results with the saved baseline.
+
+# In[ ]:
+
+
+with open('./benchmarks/baseline.json', 'r') as f:
+    saved_baseline = json.load(f)
+
+current = run_benchmarks(rows=20000, quoted_ratio=0.1)
+comparison = compare_benchmarks(current, saved_baseline)
+[name for name, stage in comparison.items() if stage['regression']]
+
+
+# ### Measuring where the time goes
+# 
+# The benchmarks measure synthetic files on our own computer. When processing real files, it's also useful to know whether a slow run spent its time reading files, parsing them, computing EMIs or writing the results, and how often the slower code paths were used. Let's add some optional *instrumentation*: timers and counters which record this information, and *sinks* which report it.
+# 
+# The class `Metrics` stores the counters (e.g. the number of rows processed), and for each timer, the number of times it was used and the total time spent. `Timer` is a context manager which adds the time spent inside a `with` block to a timer. The method `flush` passes a snapshot of the metrics to the sink. The method `in_worker` tells whether the metrics are being used in a worker process (created by forking the process that created them); the first time it's called in a worker, it clears the copy of the parent's metrics inherited by the worker.
+
+# In[ ]:
+
+
+import logging
+from contextlib import nullcontext
+from functools import wraps
+
+class Timer:
+    __slots__ = ('metrics', 'name', 'start')
+    
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+class Metrics:
+    def __init__(self, sink=None):
+        self.counters = {}
+        self.timers = {}  # name -> [calls, total seconds]
+        self.sink = sink
+        self.pid = os.getpid()
+        self.worker = False
+    
+    def in_worker(self):
+        # A forked worker process starts with a copy of the parent's metrics,
+        # which are cleared so that they aren't reported twice
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.counters = {}
+            self.timers = {}
+            self.worker = True
+        return self.worker
+    
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+    
+    def timer(self, name):
+        return Timer(self, name)
+    
+    def add_time(self, name, seconds):
+        entry = self.timers.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+    
+    def snapshot(self):
+        return {'counters': dict(self.counters), 
+                'timers': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.timers.items()}}
+    
+    def flush(self):
+        if self.sink is not None:
+            self.sink(self.snapshot())
+
+
+# The instrumentation is disabled by default, and enabled using `enable_instrumentation`, which stores a `Metrics` object in the global variable `instrumentation`. To keep the cost close to nothing when it's disabled:
+# 
+# * `timed` returns the same do-nothing context manager (`nullcontext`) every time, without creating any objects.
+# * In frequently called code, the counters are updated directly with `if instrumentation is not None: ...`, which costs a single comparison when disabled. The function `increment` does the same for less frequently called code.
+# * The decorator `instrumented` times every call of a function, but only checks `instrumentation` when disabled.
+
+# In[ ]:
+
+
+instrumentation = None
+NO_TIMER = nullcontext()
+
+def enable_instrumentation(sink=None):
+    global instrumentation
+    instrumentation = Metrics(sink)
+    return instrumentation
+
+def disable_instrumentation():
+    global instrumentation
+    if instrumentation is not None:
+        instrumentation.flush()
+    instrumentation = None
+
+def timed(name):
+    if instrumentation is None:
+        return NO_TIMER
+    return instrumentation.timer(name)
+
+def increment(name, n=1):
+    if instrumentation is not None:
+        instrumentation.count(name, n)
+
+def instrumented(name=None):
+    def decorator(function):
+        timer_name = name or function.__name__
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if instrumentation is None:
+                return function(*args, **kwargs)
+            with instrumentation.timer(timer_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# A sink is simply a function which receives a snapshot of the metrics. Let's define three kinds of sinks:
+# 
+# * `log_sink` writes the metrics to a log using the [`logging`](https://docs.python.org/3/library/logging.html) module.
+# * `jsonl_sink` appends the metrics to a *JSON lines* file, with one JSON object per line, along with the time and the process ID.
+# * `prometheus_sink` writes the metrics in the text format of the [Prometheus](https://prometheus.io/docs/instrumenting/exposition_formats/) monitoring system, which can read such files using the "textfile collector" of its node exporter. The file is replaced atomically, so that it's never read while half-written. Each flush replaces the whole file with the metrics of a single process, so worker processes write their own files (with the process ID added to the name, e.g. `metrics.1234.prom`), and every value has a `pid` label. The collector reads all the `.prom` files in its directory, so the totals can be computed by summing over `pid`. Files from worker processes that have finished are left behind, so the directory should be cleaned up between runs.
+
+# In[ ]:
+
+
+def log_sink(logger=None, level=logging.INFO):
+    logger = logger or logging.getLogger('loans')
+    def sink(snapshot):
+        logger.log(level, 'metrics: %s', json.dumps(snapshot))
+    return sink
+
+def jsonl_sink(path):
+    def sink(snapshot):
+        line = json.dumps(dict(snapshot, time=time.time(), pid=os.getpid())) + '\n'
+        with open(path, 'a') as f:
+            f.write(line)
+    return sink
+
+def prometheus_sink(path, prefix='loans'):
+    owner_pid = os.getpid()
+    def sink(snapshot):
+        pid = os.getpid()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = '{}_{}_total'.format(prefix, name)
+            lines += ['# TYPE {} counter'.format(metric), '{}{{pid="{}"}} {}'.format(metric, pid, value)]
+        for kind, metric in [('calls', prefix + '_stage_calls_total'), ('seconds', prefix + '_stage_seconds_total')]:
+            lines.append('# TYPE {} counter'.format(metric))
+            for name, timer in sorted(snapshot['timers'].items()):
+                lines.append('{}{{stage="{}",pid="{}"}} {}'.format(metric, name, pid, timer[kind]))
+        # Worker processes write separate files, instead of replacing each other's metrics
+        if pid != owner_pid:
+            root, ext = os.path.splitext(path)
+            path_for_pid = '{}.{}{}'.format(root, pid, ext)
+        else:
+            path_for_pid = path
+        temp_path = temp_output_path(path_for_pid)
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path_for_pid)
+    return sink
+
+
+# Now let's add counters to the slower code paths:
+# 
+# * `parse_value` and `parse_values` count the values which couldn't be converted to numbers (`parse_strings`).
+# * The line parser created by `make_line_parser` counts the lines which didn't match the sample and had to be parsed using `parse_values` (`parse_fallbacks`).
+# * `loan_emi` and the function cached by `make_cached_loan_emi` count the loans for which the formula divided by zero (`emi_zero_division`). Since `cached_loan_emi` only computes each EMI once, the latter counts distinct loan terms rather than loans.
+
+# In[ ]:
+
+
+def parse_value(item):
+    if item == '':
+        return 0.0
+    first = item[0]
+    if first.isdigit() or first in '+-.' or first.isspace() or item.strip().lower() in SPECIAL_FLOATS:
+        try:
+            return float(item)
+        except ValueError:
+            pass
+    if instrumentation is not None:
+        instrumentation.count('parse_strings')
+    return item
+
+def parse_values(data_line):
+    if '"' in data_line:
+        return [parse_value(item) for item in split_quoted_line(data_line.strip())]
+    values = []
+    for item in data_line.strip().split(','):
+        if item == '':
+            values.append(0.0)
+        else:
+            try:
+                values.append(float(item))
+            except ValueError:
+                if instrumentation is not None:
+                    instrumentation.count('parse_strings')
+                values.append(item)
+    return values
+
+def make_line_parser(converters):
+    num_columns = len(converters)
+    numeric_columns = [i for i, convert in enumerate(converters) if convert is parse_number]
+    other_columns = [i for i, convert in enumerate(converters) if convert is not parse_number]
+    
+    def parse_line(data_line):
+        if '"' in data_line:
+            items = split_quoted_line(data_line.strip())
+        else:
+            items = data_line.strip().split(',')
+        if len(items) == num_columns:
+            try:
+                for i in numeric_columns:
+                    item = items[i]
+                    items[i] = float(item) if item else 0.0
+                for i in other_columns:
+                    items[i] = converters[i](items[i])
+                return items
+            except ValueError:
+                pass
+        # Fall back to parsing lines that don't match the sample
+        if instrumentation is not None:
+            instrumentation.count('parse_fallbacks')
+        return parse_values(data_line)
+    
+    return parse_line
+
+
+# In[ ]:
+
+
+def loan_emi(amount, duration, rate, down_payment=0):
+    """Calculates the equal montly installment (EMI) for a loan.
+    
+    Arguments:
+        amount - Total amount to be spent (loan + down payment)
+        duration - Duration of the loan (in months)
+        rate - Rate of interest (monthly)
+        down_payment (optional) - Optional intial payment (deducted from amount)
+    """
+    loan_amount = amount - down_payment
+    try:
+        emi = loan_amount * rate * ((1+rate)**duration) / (((1+rate)**duration)-1)
+    except ZeroDivisionError:
+        if instrumentation is not None:
+            instrumentation.count('emi_zero_division')
+        emi = loan_amount / duration
+    emi = math.ceil(emi)
+    return emi
+
+def make_cached_loan_emi(maxsize=100000, policy='lru', factor_maxsize=10000):
+    @lru_cache(maxsize=factor_maxsize)
+    def growth_factor(rate, duration):
+        return (1+rate)**duration
+    
+    def emi_with_cached_factor(amount, duration, rate, down_payment=0):
+        loan_amount = amount - down_payment
+        factor = growth_factor(rate, duration)
+        try:
+            emi = loan_amount * rate * factor / (factor-1)
+        except ZeroDivisionError:
+            if instrumentation is not None:
+                instrumentation.count('emi_zero_division')
+            emi = loan_amount / duration
+        emi = math.ceil(emi)
+        return emi
+    
+    if policy == 'lru':
+        cached_loan_emi = lru_cache(maxsize=maxsize)(emi_with_cached_factor)
+    elif policy == 'lfu':
+        cached_loan_emi = memoize(LFUCache(maxsize))(emi_with_cached_factor)
+    else:
+        raise ValueError("policy must be 'lru' or 'lfu', not {!r}".format(policy))
+    cached_loan_emi.growth_factor = growth_factor
+    return cached_loan_emi
+
+cached_loan_emi = make_cached_loan_emi()
+
+
+# Finally, let's add timers to `process_file`. The file is still read and parsed line by line by `read_csv`, without reading the whole file into memory first. To tell the time spent reading the file apart from the time spent parsing it, `iter_csv_lines` wraps the lines in a `TimedLines` object when the instrumentation is enabled, which adds up the time spent waiting for each line, and adds it to the timer `read_lines` at the end. `process_file` times the whole `read_csv` call, and records the rest of the time (spent splitting the lines, converting the values and creating the rows) as `parse`. Timing every line adds a little overhead, which is counted as reading time. The counters `parse_strings` and `parse_fallbacks` show how often the slower parsing code was used. When the instrumentation is disabled, `process_file` works exactly as before.
+# 
+# Keep in mind that `process_files` and `watch_directory` run `process_file` in separate worker processes, each with its own copy of `instrumentation`. To make their metrics visible, `process_file` flushes the metrics to the sink after each file when it runs in a worker process (after clearing the metrics inherited from the parent process, the first time). A JSON lines sink works best for this, since each line includes the ID of the process that wrote it.
+
+# In[ ]:
+
+
+class TimedLines:
+    __slots__ = ('lines', 'seconds')
+    
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.seconds = 0.0
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.lines)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+def iter_csv_lines(lines, sample_size=100, strict=False, record=None):
+    # Measure the time spent reading the lines, apart from parsing them
+    timed_lines = None
+    if instrumentation is not None:
+        lines = timed_lines = TimedLines(lines)
+    lines = iter(lines)
+    try:
+        # Parse the header (an empty file has no rows)
+        header_line = next(lines, '')
+        if header_line == '':
+            return
+        headers = parse_headers(header_line)
+        # Choose how to parse the lines
+        if not strict:
+            sample = list(islice(lines, sample_size))
+            parse_line = make_line_parser(infer_converters(sample, len(headers)))
+            lines = chain(sample, lines)
+        else:
+            parse_line = parse_numeric_line
+        # Choose how to create the rows
+        if record is None:
+            create_item = partial(create_item_dict, headers=headers)
+        else:
+            create_item = record_factory(headers, record)
+        # Parse the lines one by one
+        for data_line in lines:
+            # Rows with quoted values can span multiple lines
+            if '"' in data_line and data_line.count('"') % 2 == 1:
+                data_line = read_record(data_line, lines)
+            yield create_item(parse_line(data_line))
+    finally:
+        if timed_lines is not None and instrumentation is not None:
+            instrumentation.add_time('read_lines', timed_lines.seconds)
+
+def process_file(input_path, output_path):
+    if instrumentation is None:
+        loans = read_csv(input_path)
+        compute_emis(loans)
+        write_csv(loans, output_path)
+        return len(loans)
+    
+    is_worker = instrumentation.in_worker()
+    read_seconds = instrumentation.timers.get('read_lines', [0, 0.0])[1]
+    start = time.perf_counter()
+    loans = read_csv(input_path)
+    read_seconds = instrumentation.timers.get('read_lines', [0, 0.0])[1] - read_seconds
+    # The rest of the time was spent parsing the lines and creating the rows
+    instrumentation.add_time('parse', time.perf_counter() - start - read_seconds)
+    with instrumentation.timer('compute_emis'):
+        compute_emis(loans)
+    with instrumentation.timer('write_csv'):
+        write_csv(loans, output_path)
+    instrumentation.count('files')
+    instrumentation.count('rows', len(loans))
+    instrumentation.count('bytes_read', os.path.getsize(input_path))
+    instrumentation.count('bytes_written', os.path.getsize(output_path))
+    # Worker processes report their metrics after each file
+    if is_worker:
+        instrumentation.flush()
+    return len(loans)
+
+
+# Let's enable the instrumentation with a Prometheus sink, process the three loan files, and look at the metrics.
+
+# In[ ]:
+
+
+enable_instrumentation(prometheus_sink('./data/metrics.prom'))
+for i in range(1, 4):
+    process_file('./data/loans{}.txt'.format(i), './data/emis{}.txt'.format(i))
+instrumentation.snapshot()
+
+
+# The timers can also be used around any block of code using `timed`, or added to a function using the `instrumented` decorator.
+
+# In[ ]:
+
+
+@instrumented()
+def total_emis(path):
+    return sum(loan['emi'] for loan in read_csv(path))
+
+with timed('all_totals'):
+    totals = [total_emis('./data/emis{}.txt'.format(i)) for i in range(1, 4)]
+instrumentation.timers
+
+
+# Disabling the instrumentation flushes the metrics to the sink one last time.
+
+# In[ ]:
+
+
+disable_instrumentation()
+with open('./data/metrics.prom', 'r') as f:
+    print(f.read())
+
+
+# ### Using the functions from other programs
+# 
+# All the functions in this notebook are defined in the notebook itself, so other programs can't use them. Running the Python script exported from the notebook isn't a good alternative: it installs packages, imports `pandas` and `jovian`, and runs every example, which takes several seconds before any file is processed. That's a problem for short-lived programs, such as worker processes that each process a few files.
+# 
+# Instead, the core functions for reading loan files, computing EMIs and writing the results are also available in the module `loan_files` (the file `loan_files.py` in the same directory as this notebook). It only imports modules from the Python standard library when it's loaded. The functions `to_dataframe` and `read_dataframe`, which convert rows into a `pandas` data frame, import `pandas` only when they're called for the first time. 
+# 
+# Let's import the module and use it to process a file.
+
+# In[ ]:
+
+
+import loan_files
+
+
+# In[ ]:
+
+
+loan_files.process_file('./data/loans1.txt', './data/emis1.txt')
+
+
+# In[ ]:
+
+
+loan_files.read_csv('./data/emis1.txt')[:3]
+
+
+# The module can also be run as a script, e.g. `python loan_files.py ./data/loans2.txt ./data/emis2.txt`.
+# 
+# To make sure that the module stays fast to load, `measure_startup` starts a new Python process which imports the module, and returns the time taken (in seconds), along with the time taken by a Python process which imports nothing. The import should take less than 50 milliseconds. The same check can be run from the command line using `python loan_files.py --startup-benchmark`, which fails (with exit code 1) if it takes longer.
+
+# In[ ]:
+
+
+loan_files.measure_startup()
+
+
+# The functions in `loan_files` are copies of the ones in this notebook, so a fix made in one place must also be made in the other. To catch copies that drift apart, `check_notebook` compares the source code of each function, class and constant in the module with its latest definition in the notebook, and returns the ones that differ. Some functions intentionally differ from the notebook (e.g. the module doesn't support records or instrumentation). These are listed in `loan_files.NOTEBOOK_DIFFERENCES`, along with fingerprints (short hashes of the source code) of both versions. If either version changes, it's reported too, so that the other copy can be checked and the fingerprints updated. The same check can be run from the command line using `python loan_files.py --check-notebook`, which fails (with exit code 1) if anything differs.
+
+# In[ ]:
+
+
+loan_files.check_notebook()
+
+
+# ### Overlapping reading, computing and writing with `asyncio`
+# 
+# Our pipeline reads a file, then computes the EMIs, then writes the results, and only then moves on to the next file. While the EMIs are being computed, the disk is idle, and while a file is being read or written, the CPU is mostly waiting. If these steps *overlap*, e.g. if the next file is read while the EMIs for the current file are being computed, the total time can be reduced.
+# 
+# The [`asyncio`](https://docs.python.org/3/library/asyncio.html) module provides a way to run several tasks at the same time in a single thread, using `async` functions (*coroutines*), which can pause at each `await` while waiting for something, letting the other tasks run. Reading and writing files can't be awaited directly, but we can run them in a pool of threads using `loop.run_in_executor`, and await the result.
+# 
+# Let's start with `aiter_csv`, an *asynchronous generator* which reads the rows of a file in batches in a separate thread and can be used with `async for`. To overlap reading with the processing of the rows, the next batch is requested before the rows of the current batch are returned.
+
+# In[ ]:
+
+
+import asyncio
+
+async def aiter_csv(path, batch_size=1000, sample_size=100, strict=False, record=None):
+    loop = asyncio.get_running_loop()
+    rows = iter_csv(path, sample_size, strict, record)
+    next_batch = loop.run_in_executor(None, list, islice(rows, batch_size))
+    try:
+        while True:
+            batch = await next_batch
+            next_batch = None
+            if not batch:
+                break
+            # Start reading the next batch while the current one is processed
+            next_batch = loop.run_in_executor(None, list, islice(rows, batch_size))
+            for row in batch:
+                yield row
+    finally:
+        # The generator can't be closed while a batch is being read
+        if next_batch is not None:
+            await asyncio.wait([next_batch])
+        rows.close()
+
+
+# `awrite_csv` writes rows to a file without blocking the other tasks. If the rows are in a list (or any other normal iterable), it simply runs `write_csv` in a thread. If they come from an asynchronous iterable (like `aiter_csv`), the rows are collected into batches, and each batch is written by `write_rows` in a thread while the next batch is being collected. Like `write_csv`, the rows are written into a temporary file, which replaces the destination once it's complete.
+
+# In[ ]:
+
+
+async def awrite_csv(items, path, formats=None, batch_size=1000):
+    loop = asyncio.get_running_loop()
+    if not hasattr(items, '__aiter__'):
+        return await loop.run_in_executor(None, partial(write_csv, items, path, formats=formats, batch_size=batch_size))
+    
+    temp_path = temp_output_path(path)
+    f = await loop.run_in_executor(None, partial(open, temp_path, 'w', buffering=1024*1024))
+    count, pending = 0, None
+    try:
+        batch = []
+        async for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                # Wait for the previous batch, and start writing this one
+                if pending is not None:
+                    count += await pending
+                pending = loop.run_in_executor(None, write_rows, f, batch, formats, batch_size)
+                batch = []
+        if pending is not None:
+            count += await pending
+            pending = None
+        if batch:
+            count += await loop.run_in_executor(None, write_rows, f, batch, formats, batch_size)
+        await loop.run_in_executor(None, f.close)
+    except BaseException:
+        if pending is not None:
+            await asyncio.wait([pending])
+        f.close()
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+    return count
+
+
+# We'll also need an asynchronous version of `iter_emis`, which computes the EMIs for the rows of an asynchronous iterable. Like `iter_emis`, it works with records as well as dictionaries.
+
+# In[ ]:
+
+
+async def aiter_emis(loans):
+    async for loan in loans:
+        if isinstance(loan, dict):
+            loan['emi'] = table_loan_emi(loan['amount'], loan['duration'], loan['rate']/12, loan['down_payment'])
+            yield loan
+        else:
+            emi = table_loan_emi(loan.amount, loan.duration, loan.rate/12, loan.down_payment)
+            yield with_field(loan, 'emi', emi)
+
+
+# Jupyter already runs an event loop, so we can't start another one using `asyncio.run` (in Jupyter, we could use `await` directly in a cell, but that doesn't work in a regular Python script). The function `run_async` runs a coroutine using `asyncio.run` in a separate thread, and waits for the result, which works in both cases.
+
+# In[ ]:
+
+
+def run_async(coroutine):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+# Now we can read a file, compute the EMIs and write the results, all at the same time.
+
+# In[ ]:
+
+
+run_async(awrite_csv(aiter_emis(aiter_csv('./data/loans1.txt')), './data/emis1.txt'))
+
+
+# In[ ]:
+
+
+read_csv('./data/emis1.txt') == list(iter_emis(read_csv('./data/loans1.txt')))
+
+
+# Finally, `aprocess_files` processes a list of files using three tasks connected by queues ([`asyncio.Queue`](https://docs.python.org/3/library/asyncio-queue.html)): the first task reads the files, the second one computes the EMIs and the third one writes the results. So while the EMIs for one file are being computed, the next file is being read and the results for the previous file are being written.
+# 
+# If one step is slower than the others (e.g. writing), the files waiting for it would pile up in memory. To prevent this, the queues can hold at most `max_pending` files: when a queue is full, the task putting files into it waits until there's space. This is called *backpressure*.
+# 
+# By default, the steps run in the default thread pool. Since computing EMIs is CPU-bound and threads share the GIL, only the I/O overlaps with the computation. To compute EMIs for several files in parallel, a `ProcessPoolExecutor` can be passed as `executor`; the EMIs are then computed by `with_emis`, which returns the rows instead of modifying the list in place (since each worker process has its own copy). Like `process_files`, it returns a summary.
+
+# In[ ]:
+
+
+def with_emis(loans):
+    compute_emis(loans)
+    return loans
+
+async def aprocess_files(inputs, output_pattern, max_pending=2, executor=None):
+    loop = asyncio.get_running_loop()
+    read_queue = asyncio.Queue(maxsize=max_pending)
+    write_queue = asyncio.Queue(maxsize=max_pending)
+    summary = {'files': 0, 'rows': 0, 'errors': {}}
+    start_time = time.perf_counter()
+    
+    def record_error(input_path, e):
+        summary['files'] += 1
+        summary['errors'][input_path] = '{}: {}'.format(type(e).__name__, e)
+    
+    async def read_files():
+        for i, input_path in enumerate(inputs, start=1):
+            try:
+                loans = await loop.run_in_executor(None, read_csv, input_path)
+            except Exception as e:
+                record_error(input_path, e)
+                continue
+            await read_queue.put((i, input_path, loans))
+        await read_queue.put(None)
+    
+    async def compute_files():
+        while True:
+            job = await read_queue.get()
+            if job is None:
+                break
+            i, input_path, loans = job
+            try:
+                loans = await loop.run_in_executor(executor, with_emis, loans)
+            except Exception as e:
+                record_error(input_path, e)
+                continue
+            await write_queue.put((i, input_path, loans))
+        await write_queue.put(None)
+    
+    async def write_files():
+        while True:
+            job = await write_queue.get()
+            if job is None:
+                break
+            i, input_path, loans = job
+            name = os.path.splitext(os.path.basename(input_path))[0]
+            try:
+                summary['rows'] += await loop.run_in_executor(None, write_csv, loans, output_pattern.format(i, name=name))
+                summary['files'] += 1
+            except Exception as e:
+                record_error(input_path, e)
+    
+    await asyncio.gather(read_files(), compute_files(), write_files())
+    summary['seconds'] = time.perf_counter() - start_time
+    return summary
+
+
+# In[ ]:
+
+
+run_async(aprocess_files(['./data/loans{}.txt'.format(i) for i in range(1, 4)], './data/emis{}.txt'))
+
+
+# Let's compare it with processing the same files one by one, using 10 files generated by `generate_loan_file`. The difference depends on how long it takes to read and write the files: when they're already in the operating system's memory (because they were just written), there's little I/O to overlap, and most of the time is spent in Python code, which can't run in parallel in several threads.
+
+# In[ ]:
+
+
+async_inputs = []
+for i in range(1, 11):
+    generate_loan_file('./benchmarks/async_loans{}.txt'.format(i), rows=20000, seed=i)
+    async_inputs.append('./benchmarks/async_loans{}.txt'.format(i))
+
+start = time.perf_counter()
+for i, input_path in enumerate(async_inputs, start=1):
+    process_file(input_path, './benchmarks/async_emis{}.txt'.format(i))
+print('One by one: {:.2f}s'.format(time.perf_counter() - start))
+
+async_summary = run_async(aprocess_files(async_inputs, './benchmarks/async_emis{}.txt'))
+print('With asyncio: {:.2f}s'.format(async_summary['seconds']))
+
+
+# ### Reading and writing compressed files
+# 
+# Loan files compress very well, since they contain mostly digits and commas. Storing (and downloading) them in a compressed format can reduce the number of bytes read from the disk or the network several times over. Python's standard library includes modules for the most common formats: [`gzip`](https://docs.python.org/3/library/gzip.html), [`bz2`](https://docs.python.org/3/library/bz2.html) and [`lzma`](https://docs.python.org/3/library/lzma.html) (for `.xz` files). The [Zstandard](https://facebook.github.io/zstd/) format (`.zst` files) is supported if the optional `zstandard` package is installed (`pip install zstandard`), or by the `compression.zstd` module in Python 3.14 and later.
+# 
+# Each of these modules provides an `open` function, which works like the built-in `open` but compresses or decompresses the data while it's being written or read, without ever storing the uncompressed file. So the rows can be parsed while the file is being decompressed.
+# 
+# To read a file, we detect its format using the first few bytes of the file (the *magic number*), since every format starts with a fixed sequence of bytes. This works even if the file has the wrong extension. When writing a file, the format is chosen based on the extension of the file name.
+
+# In[ ]:
+
+
+import gzip
+import bz2
+import lzma
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+COMPRESSION_MAGIC = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.zst': 'zstd'}
+
+def detect_compression(path):
+    with open(path, 'rb') as f:
+        start = f.read(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if start.startswith(magic):
+            return compression
+    return None
+
+def compression_from_extension(path):
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+# Most compression formats have to be decompressed from the beginning to the end, so only one CPU core can be used. However, a gzip file can consist of several independently compressed *members*, one after the other (standard gzip tools decompress them as a single file). The [BGZF](https://samtools.github.io/hts-specs/SAMv1.pdf) format, widely used for genomics data, splits a file into blocks of up to 64 KB, each compressed as a separate gzip member, and stores the size of each block in the "extra field" of the gzip header. Since the size of each block is known, all the blocks can be found without decompressing anything, and decompressed in parallel.
+# 
+# Let's write a function to read the blocks of a BGZF file one by one. Each block starts with the bytes `1f 8b 08 04` (gzip, compressed using deflate, with an extra field), followed by the length of the extra field (at offset 10), which contains a subfield `BC` with the size of the block. `read_bgzf_block` reads the header of the next block, and then the rest of the block. It returns an empty bytes object at the end of the file, and `None` if the next gzip member isn't a BGZF block.
+
+# In[ ]:
+
+
+BGZF_HEADER = b'\x1f\x8b\x08\x04'
+
+def bgzf_block_size(data, start):
+    if data[start:start+4] != BGZF_HEADER:
+        return None
+    extra_length, = struct.unpack_from('<H', data, start + 10)
+    offset, end = start + 12, start + 12 + extra_length
+    while offset + 4 <= end:
+        subfield, length = data[offset:offset+2], struct.unpack_from('<H', data, offset + 2)[0]
+        if subfield == b'BC' and length == 2:
+            return struct.unpack_from('<H', data, offset + 4)[0] + 1
+        offset += 4 + length
+    return None
+
+def read_bgzf_block(f):
+    # Read the fixed part of the header, then the extra field, then the rest of the block
+    header = f.read(12)
+    if header == b'':
+        return b''
+    if len(header) < 12 or header[:4] != BGZF_HEADER:
+        return None
+    extra_length, = struct.unpack_from('<H', header, 10)
+    header += f.read(extra_length)
+    size = bgzf_block_size(header, 0) if len(header) == 12 + extra_length else None
+    if size is None or size < len(header):
+        return None
+    rest = f.read(size - len(header))
+    if len(rest) < size - len(header):
+        return None
+    return header + rest
+
+
+# `iter_bgzf_chunks` decompresses the blocks of a BGZF file in parallel using a pool of threads (`zlib` releases the GIL while decompressing), and returns the decompressed data in order. To limit the memory used, the blocks are read from the file as they're needed, and at most `2 * workers` blocks are read and decompressed ahead of the block being returned. If the file continues with gzip members that aren't BGZF blocks (e.g. a regular gzip file concatenated to a BGZF file), the rest of the file is decompressed one member after another by `gzip`, just like `gzip.open` would. The class `ChunkReader` turns the decompressed chunks back into a file object, which can be wrapped in an `io.TextIOWrapper` to read it line by line.
+
+# In[ ]:
+
+
+from collections import deque
+
+def iter_bgzf_chunks(path, workers):
+    with open(path, 'rb') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        while True:
+            start = f.tell()
+            block = read_bgzf_block(f)
+            if not block:
+                break
+            # Decompress the block as a gzip member (wbits=31), which checks its CRC
+            pending.append(executor.submit(zlib.decompress, block, 31))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+        
+        if block is None:
+            # The rest of the file isn't BGZF (e.g. a gzip file was appended to it),
+            # so decompress it from the start of that member, one member after another
+            f.seek(start)
+            with gzip.GzipFile(fileobj=f) as rest:
+                while True:
+                    chunk = rest.read(1024*1024)
+                    if not chunk:
+                        break
+                    yield chunk
+
+class ChunkReader(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = b''
+        self.offset = 0
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while self.offset == len(self.chunk):
+            self.chunk = next(self.chunks, None)
+            self.offset = 0
+            if self.chunk is None:
+                self.chunk = b''
+                return 0
+        n = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:n] = self.chunk[self.offset:self.offset+n]
+        self.offset += n
+        return n
+    
+    def close(self):
+        self.chunks.close()
+        super().close()
+
+
+# To write BGZF files, the class `BlockGzipWriter` collects the data written to it, splits it into blocks of 65,280 bytes (the block size used by the `bgzip` tool), and compresses several blocks at the same time using a pool of threads. Each block is written as a gzip member with the `BC` subfield, and the file ends with an empty block, which marks the end of a BGZF file.
+
+# In[ ]:
+
+
+BGZF_BLOCK_SIZE = 65280
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def compress_bgzf_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4sIBBH2sHH', BGZF_HEADER, 0, 0, 255, 6, b'BC', 2, len(compressed) + 25)
+    return header + compressed + struct.pack('<II', zlib.crc32(data), len(data))
+
+class BlockGzipWriter(io.RawIOBase):
+    def __init__(self, path, workers=4, level=6):
+        self.file = open(path, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.level = level
+        self.buffer = bytearray()
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= BGZF_BLOCK_SIZE * self.workers:
+            self.write_blocks(len(self.buffer) // BGZF_BLOCK_SIZE * BGZF_BLOCK_SIZE)
+        return len(data)
+    
+    def write_blocks(self, size):
+        blocks = [bytes(self.buffer[i:i+BGZF_BLOCK_SIZE]) for i in range(0, size, BGZF_BLOCK_SIZE)]
+        del self.buffer[:size]
+        for block in self.executor.map(compress_bgzf_block, blocks, repeat(self.level)):
+            self.file.write(block)
+    
+    def close(self):
+        if not self.closed:
+            try:
+                self.write_blocks(len(self.buffer))
+                self.file.write(BGZF_EOF)
+            finally:
+                self.executor.shutdown()
+                self.file.close()
+        super().close()
+
+
+# Now we can define `open_compressed`, which opens a file for reading or writing in text mode, using the right module for the format. With `compression='infer'` (the default), the format is detected from the contents of the file when reading, and from the extension when writing; pass `compression=None` to disable compression, or one of `'gzip'`, `'bz2'`, `'xz'` or `'zstd'`. With `workers` greater than 1, BGZF files are decompressed in parallel when reading, and gzip files are written as BGZF files compressed in parallel when writing (other gzip files are read as usual).
+# 
+# Appending to a compressed file would add a separate compressed part without reading the existing one, so `write_rows` would have no way to tell whether the headers have already been written; appending is therefore only supported for uncompressed files.
+
+# In[ ]:
+
+
+def open_compressed(path, mode='r', compression='infer', workers=1):
+    if compression == 'infer':
+        compression = detect_compression(path) if mode == 'r' else compression_from_extension(path)
+    if compression is None:
+        return open(path, mode, buffering=1024*1024)
+    if mode not in ('r', 'w'):
+        raise ValueError('compressed files can only be opened for reading or writing, not {!r}'.format(mode))
+    
+    if compression == 'gzip' and workers > 1:
+        if mode == 'w':
+            return io.TextIOWrapper(io.BufferedWriter(BlockGzipWriter(path, workers), 1024*1024))
+        with open(path, 'rb') as f:
+            is_bgzf = bgzf_block_size(f.read(1024), 0) is not None
+        if is_bgzf:
+            return io.TextIOWrapper(io.BufferedReader(ChunkReader(iter_bgzf_chunks(path, workers)), 1024*1024))
+    if compression == 'gzip':
+        return gzip.open(path, mode + 't', compresslevel=6)
+    if compression == 'bz2':
+        return bz2.open(path, mode + 't')
+    if compression == 'xz':
+        return lzma.open(path, mode + 't')
+    if compression == 'zstd':
+        if zstd is None:
+            raise ValueError('reading or writing .zst files requires the zstandard package')
+        return zstd.open(path, mode + 't')
+    raise ValueError('unknown compression: {!r}'.format(compression))
+
+
+# Finally, let's update `iter_csv`, `parse_csv`, `write_rows`, `write_csv` and `awrite_csv` to use `open_compressed`:
+# 
+# * `parse_csv` can't split a compressed file into chunks at arbitrary byte positions, so for compressed files the `workers` are used to decompress the file instead.
+# * `write_rows` uses `f.tell()` to check whether the file is empty, but most compressed files don't support `tell` when writing. Since compressed files are never appended to, `write_csv` tells `write_rows` to write the headers using the new argument `write_headers`.
+# * In `write_csv` and `awrite_csv`, the format is chosen using the final name of the file (not the name of the temporary file).
+# * `awrite_csv` writes an asynchronous iterable in batches, so it writes the headers with the first batch only.
+
+# In[ ]:
+
+
+def iter_csv(path, sample_size=100, strict=False, record=None, compression='infer', workers=1):
+    # Open the (possibly compressed) file in read mode
+    with open_compressed(path, 'r', compression, workers) as f:
+        yield from iter_csv_lines(f, sample_size, strict, record)
+
+def parse_csv(path, workers=1, chunk_size=16*1024*1024, record=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        return list(iter_csv(path, record=record))
+    # Compressed files are decompressed in parallel instead
+    if detect_compression(path) is not None:
+        return list(iter_csv(path, record=record, workers=workers))
+    
+    # Parse the header
+    with open(path, 'r') as f:
+        header_line = f.readline()
+    if header_line == '':
+        return []
+    headers = parse_headers(header_line)
+    
+    # Small files aren't worth splitting
+    chunks = find_chunks(path, chunk_size)
+    if len(chunks) <= 1:
+        return list(iter_csv(path, record=record))
+    
+    # Parse the chunks in parallel & combine the results in order
+    result = []
+    starts, ends = zip(*chunks)
+    if record is not None:
+        create_item = record_factory(headers, record)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for rows in executor.map(parse_chunk, repeat(path), starts, ends, repeat(headers), repeat(record)):
+            if record is not None:
+                rows = map(create_item, rows)
+            result.extend(rows)
+    return result
+
+def write_rows(f, items, formats=None, batch_size=1000, write_headers=None):
+    count = 0
+    # Return if there's nothing to write
+    items = iter(items)
+    first_item = next(items, None)
+    if first_item is None:
+        return count
+    
+    # Write the headers in the first line (unless we're appending to a file)
+    is_dict = isinstance(first_item, dict)
+    if is_dict:
+        headers = list(first_item.keys())
+    else:
+        headers = list(record_fields(type(first_item)))
+    if write_headers is None:
+        write_headers = f.tell() == 0
+    if write_headers:
+        f.write(','.join(map(quote_value, headers)) + '\n')
+    
+    # Write the items in batches
+    format_row = make_row_formatter(headers, is_dict, formats)
+    batch = [format_row(first_item)]
+    for item in items:
+        batch.append(format_row(item))
+        if len(batch) >= batch_size:
+            f.write('\n'.join(batch) + '\n')
+            count += len(batch)
+            batch = []
+    if batch:
+        f.write('\n'.join(batch) + '\n')
+        count += len(batch)
+    return count
+
+def write_csv(items, path, mode='w', formats=None, batch_size=1000, buffer_size=1024*1024, atomic=True, sync=False, 
+              compression='infer', workers=1):
+    if compression == 'infer':
+        compression = compression_from_extension(path)
+    atomic = atomic and mode == 'w'
+    target = temp_output_path(path) if atomic else path
+    try:
+        # Open the file in write (or append) mode
+        if compression is None:
+            f = open(target, mode, buffering=buffer_size)
+        else:
+            f = open_compressed(target, mode, compression, workers)
+        with f:
+            count = write_rows(f, items, formats, batch_size, write_headers=True if compression else None)
+        # Compressed data is only complete once the file is closed
+        if sync is True:
+            fsync_path(target)
+    except BaseException:
+        if atomic and os.path.exists(target):
+            os.remove(target)
+        raise
+    
+    # Replace the destination with the complete file
+    if isinstance(sync, GroupCommit):
+        sync.add(path, target if atomic else None)
+    elif atomic:
+        os.replace(target, path)
+        if sync is True:
+            fsync_directory(os.path.dirname(path))
+    return count
+
+async def awrite_csv(items, path, formats=None, batch_size=1000, compression='infer', workers=1):
+    loop = asyncio.get_running_loop()
+    if not hasattr(items, '__aiter__'):
+        return await loop.run_in_executor(None, partial(write_csv, items, path, formats=formats, batch_size=batch_size, 
+                                                        compression=compression, workers=workers))
+    
+    if compression == 'infer':
+        compression = compression_from_extension(path)
+    temp_path = temp_output_path(path)
+    if compression is None:
+        f = await loop.run_in_executor(None, partial(open, temp_path, 'w', buffering=1024*1024))
+    else:
+        f = await loop.run_in_executor(None, open_compressed, temp_path, 'w', compression, workers)
+    count, pending = 0, None
+    try:
+        batch, first_batch = [], True
+        async for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                # Wait for the previous batch, and start writing this one
+                if pending is not None:
+                    count += await pending
+                pending = loop.run_in_executor(None, write_rows, f, batch, formats, batch_size, first_batch)
+                batch, first_batch = [], False
+        if pending is not None:
+            count += await pending
+            pending = None
+        if batch:
+            count += await loop.run_in_executor(None, write_rows, f, batch, formats, batch_size, first_batch)
+        await loop.run_in_executor(None, f.close)
+    except BaseException:
+        if pending is not None:
+            await asyncio.wait([pending])
+        f.close()
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+    return count
+
+
+# Let's try it out by writing the EMIs for the benchmark file in different formats, and comparing the sizes of the files.
+
+# In[ ]:
+
+
+benchmark_loans = read_csv('./benchmarks/loans.txt')
+compute_emis(benchmark_loans)
+compressed_paths = ['./benchmarks/emis.txt', './benchmarks/emis.txt.gz', './benchmarks/emis.txt.bz2', './benchmarks/emis.txt.xz']
+if zstd is not None:
+    compressed_paths.append('./benchmarks/emis.txt.zst')
+for path in compressed_paths:
+    write_csv(benchmark_loans, path)
+{path: os.path.getsize(path) for path in compressed_paths}
+
+
+# All of them can be read back using `read_csv`, which detects the format automatically.
+
+# In[ ]:
+
+
+all(read_csv(path) == benchmark_loans for path in compressed_paths)
+
+
+# Finally, let's write a BGZF file using 4 threads, and read it back using 4 threads. The result is a valid gzip file, which can also be read using `gzip.open` (or any gzip tool).
+
+# In[ ]:
+
+
+write_csv(benchmark_loans, './benchmarks/emis_blocks.txt.gz', workers=4)
+read_csv('./benchmarks/emis_blocks.txt.gz', workers=4) == benchmark_loans
+
+
+# `awrite_csv` compresses the rows in the same way, even when they come from an asynchronous iterable like `aiter_csv`.
+
+# In[ ]:
+
+
+async def copy_compressed(source, destination):
+    return await awrite_csv(aiter_csv(source), destination, batch_size=10000)
+
+run_async(copy_compressed('./benchmarks/emis.txt', './benchmarks/emis_async.txt.gz'))
+detect_compression('./benchmarks/emis_async.txt.gz'), read_csv('./benchmarks/emis_async.txt.gz') == benchmark_loans
+
+
+# In[ ]:
+
+
+with gzip.open('./benchmarks/emis_blocks.txt.gz', 'rt') as f:
+    print(f.readline())
+
+
+# The module `loan_files` supports compressed files in the same way. To keep it fast to load, it only imports `gzip`, `bz2`, `lzma` or `zstandard` when a file in that format is opened for the first time.
+
+# In[ ]:
+
+
+loan_files.read_csv('./benchmarks/emis_blocks.txt.gz', workers=4) == benchmark_loans
+
+
 # ### Save and upload your notebook
 # 
 # Whether you're running this Jupyter notebook online or on your computer, it's essential to save your work from time to time. You can continue working on a saved notebook later or share it with friends and colleagues to let them execute your code. [Jovian](https://www.jovian.ai) offers an easy way of saving and sharing your Jupyter notebooks online.